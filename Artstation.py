@@ -1,57 +1,40 @@
-import os
-import glob
-import json
 import logging
 import arrow
-import requests
 import keys
 import common
-import settings
-from time import sleep
 from math import ceil
-import random
-from pprint import pprint
 
 
 class ASFavs(common.Favs):
+    url = "https://www.artstation.com"
+
     def __init__(self):
         super().__init__("artstation")
         self.user = keys.artstation.get("username")
-        self.session = requests.Session()
-        self.session.headers.update({
+        self.headers = {
             "User-Agent": "Mozilla/5.0 (X11; Linux x86_64; rv:69.0) Gecko/20100101 Firefox/69.0",
             "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
             "Accept-Language": "en-US,en;q=0.5",
             #"DNT": "1",
-            "Connection": "keep-alive",
             "Upgrade-Insecure-Requests": "1",
             "Pragma": "no-cache",
             "Cache-Control": "max-age=0, no-cache",
-        })
-
-
-session.headers.update({
-    "User-Agent": "Mozilla/5.0 (X11; Linux x86_64; rv:69.0) Gecko/20100101 Firefox/69.0",
-    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
-    "Accept-Language": "en-US,en;q=0.5",
-    "DNT": "1",
-    "Connection": "keep-alive",
-    "Upgrade-Insecure-Requests": "1",
-    "Pragma": "no-cache",
-    "Cache-Control": "max-age=0, no-cache",
-})
+        }
 
     def paged_likes(self, page=1):
-        url = "https://www.artstation.com/users/%s/likes.json?page=%s" % (
+        url = "%s/users/%s/likes.json?page=%s" % (
+            self.url,
             self.user,
             page,
         )
-        js = self.session.get(url)
-        while js.status_code != requests.codes.ok:
-            # FU cloudflare
-            pprint(self.session.cookies)
-            sleep(round(random.uniform(0.7,3.5), 2))
-            js = self.session.get(url)
+        # FU cloudflare
+        js = common.http().get(
+            url, headers=self.headers, retry_on=common.RETRY_STATUSES | {403}
+        )
+        if js.status_code != 200:
+            logging.error("fetching artstation likes page %d failed: %d", page, js.status_code)
+            return None
+        common.metrics().inc("api_pages_total", silo=self.silo)
         try:
             js = js.json()
             if "data" not in js:
@@ -61,26 +44,23 @@ session.headers.update({
             logging.error("fetching artstation failed: %s, response: %s", e, js.text)
             return None
 
-    @property
     def likes(self):
-        js = self.paged_likes(1)
-        if not js:
-            return []
-        likes = js.get("data", [])
-        pages = ceil(js.get("total_count", 1) / 50)
-        while pages > 1:
-            extras = self.paged_likes(pages)
-            if not extras:
-                continue
-            likes = likes + extras.get("data", [])
-            pages = pages - 1
-        return likes
+        """ pages of likes as they come in, one held at a time """
+        page = 1
+        pages = 1
+        while page <= pages:
+            js = self.paged_likes(page)
+            if not js:
+                break
+            pages = ceil(js.get("total_count", 1) / 50)
+            yield js.get("data", [])
+            page = page + 1
 
     @property
     def feeds(self):
         feeds = []
-        url = "https://www.artstation.com/users/%s/following.json" % (self.user)
-        js = self.session.get(url, headers=self.headers)
+        url = "%s/users/%s/following.json" % (self.url, self.user)
+        js = common.http().get(url, headers=self.headers)
         try:
             js = js.json()
             if "data" not in js:
@@ -99,17 +79,20 @@ session.headers.update({
             logging.error("parsing artstation follows failed: %s", e)
         return feeds
 
-    def run(self):
+    def favs(self):
         # FU cloudflare
-        for like in self.likes:
-            like = ASLike(like, self.session, self.headers)
-            like.run()
+        for page in self.likes():
+            favs = [ASLike(like, self.headers) for like in page]
+            known = self.seen(favs)
+            for fav in favs:
+                yield fav
+            if known:
+                break
 
 
 class ASLike(common.ImgFav):
-    def __init__(self, like, session, headers):
+    def __init__(self, like, headers):
         self.like = like
-        self.session = session
         self.headers = headers
 
     def __str__(self):
@@ -119,10 +102,10 @@ class ASLike(common.ImgFav):
     def url(self):
         return self.like.get("permalink")
 
-    @property
+    @common.cached_property
     def data(self):
         purl = "%s.json" % (self.url.replace("artwork", "projects"))
-        data = self.session.get(purl, headers=self.headers)
+        data = common.http().get(purl, headers=self.headers, cache=True)
         try:
             data = data.json()
         except Exception as e:
@@ -163,15 +146,14 @@ class ASLike(common.ImgFav):
 
     @property
     def targetprefix(self):
-        return os.path.join(
-            settings.paths.get("archive"),
-            "favorite",
+        return common.favprefix(
             "artstation_%s_%s_%s"
             % (
                 common.url2slug("%s" % self.like.get("user").get("username")),
                 self.like.get("hash_id"),
                 self.slug,
             ),
+            self.published,
         )
 
     @property
@@ -1,11 +1,8 @@
-import os
-import glob
 import deviantart
 from bleach import clean
 import arrow
 import keys
 import common
-import settings
 from pprint import pprint
 import logging
 
@@ -47,7 +44,7 @@ class DAFavs(common.Favs):
                 break
         return feeds
 
-    def run(self):
+    def favs(self):
         offset = 0
         while not self.favfolder:
             logging.info("fetching for DeviantArt: offset %d" % offset)
@@ -55,6 +52,7 @@ class DAFavs(common.Favs):
                 folders = self.client.get_collections(
                     username=keys.deviantart.get("username"), offset=offset, limit=24
                 )
+                common.metrics().inc("api_pages_total", silo=self.silo)
                 offset = folders.get("next_offset")
                 for r in folders.get("results"):
                     if r.get("name") == "Featured":
@@ -62,8 +60,8 @@ class DAFavs(common.Favs):
                 if folders.get("has_more") == False:
                     break
             except deviantart.api.DeviantartError as e:
-                print(e)
-                break
+                logging.error("fetching DeviantArt favs failed: %s", e)
+                raise
 
         offset = 0
         has_more = True
@@ -76,16 +74,20 @@ class DAFavs(common.Favs):
                     limit=24,
                     # mature_content=True
                 )
-                for r in fetched.get("results"):
-                    fav = DAFav(r)
-                    fav.run()
+                common.metrics().inc("api_pages_total", silo=self.silo)
+                favs = [DAFav(r) for r in fetched.get("results")]
+                known = self.seen(favs)
+                for fav in favs:
+                    yield fav
+                if known:
+                    break
                 offset = fetched.get("next_offset")
                 has_more = fetched.get("has_more")
                 if has_more == False:
                     break
             except deviantart.api.DeviantartError as e:
-                print(e)
-                break
+                logging.error("fetching DeviantArt favs failed: %s", e)
+                raise
 
 
 class DAFav(common.ImgFav):
@@ -127,15 +129,14 @@ class DAFav(common.ImgFav):
 
     @property
     def targetprefix(self):
-        return os.path.join(
-            settings.paths.get("archive"),
-            "favorite",
+        return common.favprefix(
             "deviantart_%s_%s_%s"
             % (
                 common.url2slug("%s" % self.deviation.author),
                 self.id.replace("-", "_"),
                 common.url2slug("%s" % self.title),
             ),
+            self.published,
         )
 
     @property
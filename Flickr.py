@@ -1,5 +1,3 @@
-import os
-import glob
 import flickr_api
 from bleach import clean
 import arrow
@@ -16,6 +14,8 @@ class FlickrFavs(common.Favs):
         flickr_api.set_keys(
             api_key=keys.flickr.get("key"), api_secret=keys.flickr.get("secret")
         )
+        if common.responses():
+            flickr_api.enable_cache(common.responses())
         self.user = flickr_api.Person.findByUserName(keys.flickr.get("username"))
 
     @property
@@ -39,31 +39,61 @@ class FlickrFavs(common.Favs):
             page = page + 1
         return feeds
 
-    def run(self):
+    def favs(self):
         pages = 1
         page = 1
         while page <= pages:
             logging.info("fetching for Flickr: page %d" % page)
             fetched = self.user.getFavorites(
-                user_id=self.user.id, page=page, min_fave_date=self.since
+                user_id=self.user.id,
+                page=page,
+                per_page=500,
+                min_fave_date=self.since,
+                extras=FlickrFav.EXTRAS,
             )
-            for p in fetched:
-                photo = FlickrFav(p)
-                photo.run()
+            common.metrics().inc("api_pages_total", silo=self.silo)
+            favs = [FlickrFav(p) for p in fetched]
+            known = self.seen(favs)
+            for fav in favs:
+                yield fav
+            if known:
+                break
             pages = fetched.info.pages
             page = page + 1
 
 
 class FlickrFav(common.ImgFav):
+    # everything the fav needs, sent along with the favorites page, so
+    # getInfo and getSizes are only called for what's missing from it
+    EXTRAS = (
+        "description,owner_name,date_upload,tags,geo,"
+        "url_o,url_k,url_h,url_l,url_m"
+    )
+    SIZES = [
+        ("Original", "url_o"),
+        ("Large 2048", "url_k"),
+        ("Large 1600", "url_h"),
+        ("Large", "url_l"),
+        ("Medium", "url_m"),
+    ]
+
     def __init__(self, flickrphoto):
         self.flickrphoto = flickrphoto
 
     def __str__(self):
         return "fav-of %s" % (self.url)
 
+    def extra(self, name):
+        """ a field of the favorites page, None if it wasn't sent; unlike
+        attribute access this never makes flickr_api load the info """
+        return self.flickrphoto.get(name)
+
     @cached_property
     def owner(self):
-        return self.info.get("owner")
+        owner = self.extra("owner")
+        if owner is None:
+            owner = self.info.get("owner")
+        return owner
 
     @cached_property
     def info(self):
@@ -71,14 +101,17 @@ class FlickrFav(common.ImgFav):
 
     @property
     def author(self):
+        name = self.extra("ownername")
+        if name is None:
+            name = self.info.get("owner").username
         return {
-            "name": "%s" % self.owner.username,
-            "url": "%s" % self.owner.getProfileUrl(),
+            "name": "%s" % name,
+            "url": "https://www.flickr.com/people/%s/" % self.owner.id,
         }
 
     @property
     def id(self):
-        return "%s" % self.info.get("id")
+        return "%s" % self.flickrphoto.id
 
     @property
     def url(self):
@@ -86,10 +119,19 @@ class FlickrFav(common.ImgFav):
 
     @property
     def content(self):
-        return "%s" % self.info.get("description")
+        description = self.extra("description")
+        if description is None:
+            description = self.info.get("description")
+        return "%s" % description
 
     @property
     def geo(self):
+        if self.extra("accuracy") is not None:
+            # geo was asked for; an accuracy of 0 means there's none
+            if not int(self.extra("accuracy")):
+                return None
+            return ("%s" % self.extra("latitude"), "%s" % self.extra("longitude"))
+
         if "location" not in self.info:
             return None
 
@@ -99,40 +141,70 @@ class FlickrFav(common.ImgFav):
 
     @property
     def title(self):
-        return clean("".strip("%s" % self.info.get("title")))
+        title = self.extra("title")
+        if title is None:
+            title = self.info.get("title")
+        return clean("".strip("%s" % title))
 
     @property
     def targetprefix(self):
-        return os.path.join(
-            settings.paths.get("archive"),
-            "favorite",
+        return common.favprefix(
             "flickr_%s_%s" % (common.url2slug("%s" % self.owner.id), self.id),
+            self.published,
         )
 
     @property
     def published(self):
-        x = self.info.get("dateuploaded")
+        x = self.extra("dateupload")
+        if x is None:
+            x = self.info.get("dateuploaded")
+        x = "%s" % x
         if x.isnumeric():
             return arrow.get(int(x))
         else:
             return arrow.get(x)
 
+    @property
+    def faved(self):
+        """ getFavorites sends the time of the fave with every photo """
+        x = self.extra("date_faved")
+        if x is None:
+            return None
+        return arrow.get(int("%s" % x))
+
     @property
     def tags(self):
+        if self.extra("tags") is not None:
+            return self.extra("tags").split()
         tags = []
         for t in self.info.get("tags"):
             tags.append("%s" % t.text)
         return tags
 
-    @property
+    @cached_property
+    def sizes(self):
+        sizes = {
+            label: {"source": self.extra(extra)}
+            for label, extra in self.SIZES
+            if self.extra(extra)
+        }
+        if not sizes:
+            sizes = self.flickrphoto.getSizes()
+        return sizes
+
+    @cached_property
     def images(self):
-        sizes = self.flickrphoto.getSizes()
-        for maybe in ["Original", "Large 2048", "Large 1600", "Large", "Medium"]:
+        """ the largest size there is; the original goes last when asked
+        to downsize while the bandwidth budget is tight """
+        sizes = self.sizes
+        labels = [label for label, extra in self.SIZES]
+        if settings.args.get("downsize") and common.bandwidth().tight("flickr"):
+            labels = labels[1:] + labels[:1]
+        for maybe in labels:
             if maybe in sizes:
                 f = "%s%s" % (self.targetprefix, common.TMPFEXT)
                 return {f: sizes.get(maybe).get("source")}
 
-
 if __name__ == "__main__":
     t = FlickrFavs()
     t.run()
@@ -1,12 +1,78 @@
 import os
-import glob
+import gzip
+import zlib
 import logging
 import json
-import requests
 from common import cached_property
+from common import http
+from common import metrics
+from common import Index
 import settings
 import keys
 
+# items fetched at the same time and appended to a segment together
+CHUNK = 100
+
+
+class Segments(object):
+    """ append-only store of JSON documents, one per line, in gzip
+    compressed segment files
+
+    every append is a gzip member of its own, so nothing written earlier
+    is ever rewritten; a member cut off by a crash is truncated before
+    the next append, using the size recorded after the last good one
+    """
+
+    SIZE = 64 * 1024 * 1024
+
+    def __init__(self, root):
+        self.root = root
+        if not os.path.isdir(root):
+            os.makedirs(root)
+
+    @property
+    def fnames(self):
+        return sorted(
+            f for f in os.listdir(self.root) if f.endswith(".jsonl.gz")
+        )
+
+    def current(self):
+        fnames = self.fnames
+        if not fnames:
+            return "%05d.jsonl.gz" % 1
+        if os.path.getsize(os.path.join(self.root, fnames[-1])) < self.SIZE:
+            return fnames[-1]
+        return "%05d.jsonl.gz" % (len(fnames) + 1)
+
+    def append(self, docs, committed=None):
+        """ returns the name of the segment and its size after the write;
+        committed is that pair from the previous append """
+        fname = self.current()
+        fpath = os.path.join(self.root, fname)
+        if committed and committed[0] == fname and os.path.exists(fpath):
+            if os.path.getsize(fpath) > committed[1]:
+                logging.warning("truncating torn write at the end of %s", fname)
+                os.truncate(fpath, committed[1])
+        data = "".join(
+            json.dumps(doc, ensure_ascii=False) + "\n" for doc in docs
+        )
+        with open(fpath, "ab") as f:
+            f.write(gzip.compress(data.encode("utf-8")))
+            f.flush()
+            os.fsync(f.fileno())
+            return fname, f.tell()
+
+    def read(self):
+        """ yields (segment name, document) for everything stored """
+        for fname in self.fnames:
+            try:
+                with gzip.open(os.path.join(self.root, fname), "rt") as f:
+                    for line in f:
+                        yield fname, json.loads(line)
+            except (EOFError, zlib.error, gzip.BadGzipFile) as e:
+                logging.error("%s is cut short: %s", fname, e)
+
+
 class HackerNews(object):
     url = "https://hacker-news.firebaseio.com/v0/"
 
@@ -15,24 +81,88 @@ class HackerNews(object):
         return os.path.join(settings.paths.get("archive"), "hn")
 
     @cached_property
-    def existing(self):
-        return [os.path.basename(fpath).replace(".json", "") for fpath in glob.glob(os.path.join(self.tdir, "*.json"))]
+    def index(self):
+        return Index.get(self.tdir, silo="hackernews")
+
+    @cached_property
+    def segments(self):
+        return Segments(os.path.join(self.tdir, "segments"))
+
+    def fetch(self, entries):
+        """ request every item of a chunk at the same time """
+        pending = [
+            (
+                entry,
+                http().submit(
+                    http().request("GET", f"{self.url}/item/{entry}.json")
+                ),
+            )
+            for entry in entries
+        ]
+        fetched = []
+        for entry, future in pending:
+            try:
+                r = future.result()
+                if r.status_code != 200:
+                    raise ValueError("status %d" % r.status_code)
+                fetched.append((entry, r.json()))
+            except Exception as e:
+                logging.error("fetching HackerNews entry %s failed: %s", entry, e)
+        return fetched
+
+    def save(self, fetched):
+        docs = [doc for entry, doc in fetched if doc]
+        fnames = []
+        if docs:
+            fname, size = self.segments.append(docs, self.index.meta("segment"))
+            self.index.setmeta("segment", [fname, size])
+            fnames = [os.path.join("segments", fname)]
+        for entry, doc in fetched:
+            logging.info("saving HackerNews entry %s", entry)
+            # items that don't exist anymore come back as null
+            self.index.add(f"{entry}", fnames=fnames if doc else [])
 
     def run(self):
         user = keys.hackernews.get("username")
-        content = requests.get(f"{self.url}/user/{user}.json")
+        content = http().get(f"{self.url}/user/{user}.json")
+        metrics().inc("api_pages_total", silo="hackernews")
+        if content.status_code != 200:
+            logging.error("fetching HackerNews user %s failed: %d", user, content.status_code)
+            return
         data = content.json()
         if "submitted" not in data:
             return
+        missing = []
         for entry in data["submitted"]:
-            if entry in self.existing:
+            if self.index.exists(f"{entry}"):
                 logging.debug("skipping HackerNews entry %s", entry)
+                metrics().inc("items_skipped_total", silo="hackernews")
                 continue
-            entry_data = requests.get(f"{self.url}/item/{entry}.json")
-            target = os.path.join(self.tdir, f"{entry}.json")
-            with open(target, "wt") as f:
-                logging.info("saving HackerNews entry %s", entry)
-                f.write(json.dumps(entry_data.json(), indent=4, ensure_ascii=False))
+            missing.append(entry)
+        for start in range(0, len(missing), CHUNK):
+            self.save(self.fetch(missing[start : start + CHUNK]))
+
+    def rebuild(self):
+        """ index the items archived as files of their own, then the
+        ones in the segments """
+        self.index.rebuild()
+        for fname, doc in self.segments.read():
+            self.index.add(
+                "%s" % doc.get("id"), fnames=[os.path.join("segments", fname)]
+            )
+
+    def export(self, target):
+        """ write every item in the segments to a JSON file of its own,
+        the way they used to be archived """
+        if not os.path.isdir(target):
+            os.makedirs(target)
+        cntr = 0
+        for fname, doc in self.segments.read():
+            fpath = os.path.join(target, "%s.json" % doc.get("id"))
+            with open(fpath, "wt") as f:
+                f.write(json.dumps(doc, indent=4, ensure_ascii=False))
+            cntr = cntr + 1
+        logging.info("exported %d HackerNews entries to %s", cntr, target)
 
 
 if __name__ == "__main__":
@@ -1,10 +1,12 @@
 import os
 import csv
 import json
+import time
+import shutil
+import asyncio
 import logging
 from operator import attrgetter
 from collections import namedtuple
-import requests
 import arrow
 from datetime import datetime
 import settings
@@ -12,12 +14,141 @@ import keys
 from pprint import pprint
 from math import floor
 from common import cached_property
+from common import http
+from common import metrics
+from common import RateLimit
+from common import TMPFEXT
 import sys
 
 Track = namedtuple(
     "Track", ["timestamp", "artist", "album", "title", "artistid", "albumid", "img"]
 )
 
+class Scrobbles(object):
+    """ the CSV archive of scrobbles
+
+    rows are appended in time order, so only the tail of the file is read
+    for the newest timestamp and the ones next to it; opening it costs
+    the same no matter how long the history is
+    """
+
+    TAIL = 64 * 1024
+    CHUNK = 1000
+
+    def __init__(self, fpath):
+        self.fpath = fpath
+        self.newest = 0
+        self.known = set()
+        if os.path.isfile(self.fpath):
+            self.load()
+
+    def load(self):
+        with open(self.fpath, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            f.seek(max(0, size - self.TAIL))
+            lines = f.read().decode("utf-8", errors="replace").splitlines()
+        if size > self.TAIL:
+            # the first line is most likely cut in half
+            lines = lines[1:]
+        for row in csv.reader(lines):
+            try:
+                ts = int(datetime.fromisoformat(row[0]).timestamp())
+            except (ValueError, IndexError):
+                continue
+            self.known.add(ts)
+            self.newest = max(self.newest, ts)
+
+    def seen(self, ts):
+        """ whether ts is archived or already came up in this run;
+        anything older than the newest row was archived before it """
+        if ts < self.newest or ts in self.known:
+            return True
+        self.known.add(ts)
+        return False
+
+    def append(self, tracks):
+        """ write tracks coming oldest first, flushing them every CHUNK
+        rows, so memory use doesn't grow with the history and whatever
+        was written before a crash is kept in order """
+        if not os.path.isfile(self.fpath):
+            with open(self.fpath, "w") as f:
+                writer = csv.DictWriter(f, fieldnames=Track._fields)
+                writer.writeheader()
+        with open(self.fpath, "a") as f:
+            writer = csv.writer(f, quoting=csv.QUOTE_NONNUMERIC)
+            chunk = []
+            for track in tracks:
+                chunk.append(track)
+                if len(chunk) >= self.CHUNK:
+                    self.flush(f, writer, chunk)
+                    chunk = []
+            self.flush(f, writer, chunk)
+
+    def flush(self, f, writer, chunk):
+        if not len(chunk):
+            return
+        writer.writerows(chunk)
+        f.flush()
+        newest = datetime.fromisoformat(chunk[-1].timestamp)
+        self.newest = max(self.newest, int(newest.timestamp()))
+
+
+class Spool(object):
+    """ pages of a fetch saved as they arrive, next to a manifest of the
+    query they belong to, so an interrupted backfill only has to fetch
+    the pages still missing """
+
+    def __init__(self, root):
+        self.root = root
+        self.manifest = os.path.join(root, "manifest.json")
+
+    def load(self):
+        if not os.path.isfile(self.manifest):
+            return None
+        try:
+            with open(self.manifest, "r") as f:
+                return json.load(f)
+        except ValueError as e:
+            logging.error("broken LastFM spool manifest: %s", e)
+            return None
+
+    def start(self, query):
+        self.clear()
+        os.makedirs(self.root)
+        self.write(self.manifest, json.dumps(query).encode("utf-8"))
+
+    def fpath(self, page):
+        return os.path.join(self.root, "%05d.json" % page)
+
+    def write(self, fpath, content):
+        tmp = "%s%s" % (fpath, TMPFEXT)
+        with open(tmp, "wb") as f:
+            f.write(content)
+        os.replace(tmp, fpath)
+
+    def save(self, page, content):
+        self.write(self.fpath(page), content)
+
+    def missing(self, total):
+        return [
+            page
+            for page in range(1, total + 1)
+            if not os.path.exists(self.fpath(page))
+        ]
+
+    def pages(self, total):
+        """ the spooled pages, oldest first; Last.fm starts with the
+        newest one """
+        for page in range(total, 0, -1):
+            with open(self.fpath(page), "r") as f:
+                yield json.load(f).get("recenttracks")
+
+    def clear(self):
+        if os.path.isdir(self.root):
+            shutil.rmtree(self.root)
+
+
 class LastFM(object):
     url = "http://ws.audioscrobbler.com/2.0/"
 
@@ -38,19 +169,8 @@ class LastFM(object):
         return os.path.join(settings.paths.get("archive"), "lastfm.csv")
 
     @cached_property
-    def existing(self):
-        timestamps = []
-        if os.path.isfile(self.target):
-            with open(self.target, "r") as f:
-                r = csv.reader(f)
-                for row in r:
-                    try:
-
-                        timestamps.append(int(datetime.fromisoformat(row[0]).timestamp()))
-                    except Exception as e:
-                        logging.error("arrow failed on row %s as: %s", row[0], e)
-                        continue
-        return timestamps
+    def scrobbles(self):
+        return Scrobbles(self.target)
 
     @property
     def exists(self):
@@ -63,9 +183,10 @@ class LastFM(object):
         for track in data.get("track", []):
             if "date" not in track:
                 continue
-            ts = arrow.get(int(track.get("date").get("uts")))
-            if ts.timestamp in self.existing:
+            uts = int(track.get("date").get("uts"))
+            if self.scrobbles.seen(uts):
                 continue
+            ts = arrow.get(uts)
             entry = Track(
                 ts.format("YYYY-MM-DDTHH:mm:ssZZ"),
                 track.get("artist").get("#text", ""),
@@ -78,47 +199,103 @@ class LastFM(object):
             tracks.append(entry)
         return tracks
 
-    def fetch(self):
-        r = requests.get(self.url, params=self.params)
-        return json.loads(r.text).get("recenttracks")
+    @cached_property
+    def spool(self):
+        return Spool(os.path.join(settings.paths.get("archive"), ".lastfm"))
 
-    def run(self):
-        if len(self.existing):
-            self.params.update({"from": sorted(self.existing)[-1]})
-        #startpage = max(1, floor(len(self.existing) / int(self.params.get("limit"))))
-        #startpage = 1
-        self.params.update({"page": 1})
-        try:
-            data = self.fetch()
-            tracks = self.extracttracks(data)
-            total = int(data.get("@attr").get("totalPages"))
-            current = int(data.get("@attr").get("page"))
-            cntr = total - current
-        except Exception as e:
-            logging.error("Something went wrong: %s", e)
-            return
+    def query(self, page):
+        params = dict(self.params)
+        params.update({"page": page, "to": self.window.get("to")})
+        if self.window.get("from"):
+            params.update({"from": self.window.get("from")})
+        return params
 
-        if not len(tracks):
-            return
+    def fetch(self, page):
+        """ the raw page; the response body is what goes in the spool """
+        r = http().get(self.url, params=self.query(page))
+        metrics().inc("api_pages_total", silo="lastfm")
+        return r
 
-        while cntr > 0:
-            current = current + 1
-            cntr = total - current
-            logging.info("requesting page #%d of paginated results", current)
-            self.params.update({"page": current})
-            data = self.fetch()
-            tracks = tracks + self.extracttracks(data)
+    async def fetchpages(self, pages):
+        """ fetch pages concurrently within the Last.fm rate limit,
+        spooling each one as soon as it arrives """
+        workers = asyncio.Semaphore(
+            max(1, int(settings.args.get("lastfm_workers")))
+        )
+        limit = RateLimit(float(settings.args.get("lastfm_rate")))
 
-        if not self.exists:
-            with open(self.target, "w") as f:
-                writer = csv.DictWriter(f, fieldnames=Track._fields)
-                writer.writeheader()
+        async def fetchpage(page):
+            async with workers:
+                await limit.wait()
+                try:
+                    r = await http().request(
+                        "GET", self.url, params=self.query(page)
+                    )
+                except Exception as e:
+                    logging.error(
+                        "requesting LastFM page #%d failed: %s", page, e
+                    )
+                    return page, None
+            metrics().inc("api_pages_total", silo="lastfm")
+            return page, r
+
+        for done in asyncio.as_completed([fetchpage(page) for page in pages]):
+            page, r = await done
+            if r is None:
+                continue
+            if r.status_code != 200:
+                logging.error(
+                    "requesting LastFM page #%d failed with status %d",
+                    page,
+                    r.status_code,
+                )
+                continue
+            logging.info("received page #%d of paginated results", page)
+            self.spool.save(page, r.content)
+
+    def run(self):
+        # the window is fixed by "to", so pages don't shift under a
+        # backfill when new scrobbles come in while it runs
+        self.window = self.spool.load()
+        if self.window and self.window.get("from") == self.scrobbles.newest:
+            logging.info(
+                "resuming LastFM backfill of %d pages", self.window.get("total")
+            )
+        else:
+            self.window = {"from": self.scrobbles.newest, "to": int(time.time())}
+            try:
+                r = self.fetch(1)
+                data = r.json().get("recenttracks")
+                self.window["total"] = int(data.get("@attr").get("totalPages"))
+            except Exception as e:
+                logging.error("Something went wrong: %s", e)
+                return
+            self.spool.start(self.window)
+            self.spool.save(1, r.content)
+
+        total = self.window.get("total")
+        missing = self.spool.missing(total)
+        if missing:
+            http().call(self.fetchpages(missing))
+        missing = self.spool.missing(total)
+        if missing:
+            logging.warning(
+                "%d LastFM pages are missing, leaving them for next run",
+                len(missing),
+            )
+            return
 
-        if len(tracks):
-            with open(self.target, "a") as f:
-                writer = csv.writer(f, quoting=csv.QUOTE_NONNUMERIC)
-                writer.writerows(sorted(tracks, key=attrgetter("timestamp")))
+        self.scrobbles.append(self.tracks(total))
+        self.spool.clear()
 
+    def tracks(self, total):
+        """ the tracks of the spooled pages, oldest first, one page in
+        memory at a time """
+        for data in self.spool.pages(total):
+            for track in sorted(
+                self.extracttracks(data), key=attrgetter("timestamp")
+            ):
+                yield track
 
 if __name__ == "__main__":
     lfm = LastFM()
@@ -1,11 +1,8 @@
-import os
-import glob
 import logging
 import pytumblr
 import arrow
 import keys
 import common
-import settings
 from bleach import clean
 from pprint import pprint
 
@@ -46,12 +43,20 @@ class TumblrFavs(common.Favs):
                 )
         return feeds
 
-    def run(self):
+    def favs(self):
         has_more = True
         after = self.since
         while has_more:
             logging.info("fetching for Tumblr: after %d" % after)
             fetched = self.client.likes(after=after)
+            common.metrics().inc("api_pages_total", silo=self.silo)
+            # pytumblr returns the error body instead of raising
+            status = fetched.get("meta", {}).get("status", 200)
+            if status >= 400 or "errors" in fetched:
+                raise IOError(
+                    "fetching Tumblr likes failed with %s: %s"
+                    % (status, fetched.get("errors") or fetched.get("meta"))
+                )
             if "liked_posts" not in fetched:
                 has_more = False
             elif "_links" in fetched and "prev" in fetched["_links"] and len(fetched):
@@ -62,9 +67,12 @@ class TumblrFavs(common.Favs):
             else:
                 has_more = False
 
-            for like in fetched.get("liked_posts"):
-                fav = TumblrFav(like)
-                fav.run()
+            # paging goes forward in time from the cursor here, so there
+            # is no stopping at a known page
+            favs = [TumblrFav(like) for like in fetched.get("liked_posts", [])]
+            self.seen(favs)
+            for fav in favs:
+                yield fav
 
 
 class TumblrFav(common.ImgFav):
@@ -101,10 +109,8 @@ class TumblrFav(common.ImgFav):
 
     @property
     def targetprefix(self):
-        return os.path.join(
-            settings.paths.get("archive"),
-            "favorite",
-            "tumblr_%s_%s" % (self.blogname, self.id),
+        return common.favprefix(
+            "tumblr_%s_%s" % (self.blogname, self.id), self.published
         )
 
     @property
@@ -1,17 +1,21 @@
 import os
-import glob
 import json
 import re
+import time
 import logging
-import requests
 import settings
 import keys
-from shutil import copyfileobj
 from common import cached_property
+from common import http
+from common import metrics
 from common import url2slug
+from common import Index
 from pprint import pprint
 
 RE_FNAME = re.compile(r"(?P<id>[0-9]+)_(?P<slug>.*).epub")
+# entries changed this long before the last sync are listed again, in
+# case the clock of the wallabag server is off
+SINCE_OVERLAP = 3600
 
 
 class Wallabag(object):
@@ -24,30 +28,50 @@ class Wallabag(object):
         return settings.paths.bookmarks
 
     @cached_property
-    def existing(self):
-        return [
-            os.path.basename(fpath)
-            for fpath in glob.glob(os.path.join(self.tdir, "*"))
-        ]
+    def index(self):
+        return Index.get(self.tdir, silo="wallabag")
 
     def archive_batch(self, entries):
+        """ export the new entries of a page at the same time; False if
+        any of them failed """
+        metrics().inc("api_pages_total", silo="wallabag")
+        pending = {}
         for entry in entries["_embedded"]["items"]:
             ename = url2slug(entry["url"])
             eid = entry["id"]
             fname = f"{ename}.epub"
             target = os.path.join(self.tdir, fname)
 
-            if fname in self.existing:
+            if self.index.exists(ename) or ename in pending:
                 logging.debug("skipping existing entry %s", entry["id"])
+                metrics().inc("items_skipped_total", silo="wallabag")
             else:
-                with requests.get(
-                    f"{keys.wallabag.url}/api/entries/{eid}/export.epub",
-                    stream=True,
-                    headers=self.auth,
-                ) as r:
-                    logging.info("saving %s to %s", eid, target)
-                    with open(target, "wb") as f:
-                        copyfileobj(r.raw, f)
+                logging.info("saving %s to %s", eid, target)
+                pending[ename] = (
+                    entry,
+                    http().submit(
+                        http().fetch(
+                            f"{keys.wallabag.url}/api/entries/{eid}/export.epub",
+                            target,
+                            headers=self.auth,
+                            silo="wallabag",
+                        )
+                    ),
+                )
+
+        complete = True
+        for ename, (entry, future) in pending.items():
+            try:
+                transfer = future.result()
+            except Exception as e:
+                logging.error("exporting %s failed: %s", entry["id"], e)
+                complete = False
+                continue
+            if not transfer.complete:
+                complete = False
+                continue
+            self.index.add(ename, url=entry["url"], fnames=[f"{ename}.epub"])
+        return complete
 
     def run(self):
         tparams = {
@@ -57,7 +81,7 @@ class Wallabag(object):
             "username": keys.wallabag.username,
             "password": keys.wallabag.password,
         }
-        token = requests.post(
+        token = http().post(
             f"{keys.wallabag.url}/oauth/v2/token", data=tparams
         )
         try:
@@ -74,8 +98,17 @@ class Wallabag(object):
         self.access_token = tdata["access_token"]
         self.auth = {"Authorization": f"Bearer {self.access_token}"}
 
-        r = requests.get(
-            f"{keys.wallabag.url}/api/entries", headers=self.auth
+        # only entries changed since the last complete sync are listed,
+        # without their content
+        started = int(time.time())
+        query = {"detail": "metadata", "perPage": 100, "page": 1}
+        since = self.index.meta("since")
+        if since:
+            query["since"] = max(0, since - SINCE_OVERLAP)
+            logging.info("listing wallabag entries changed since %d", since)
+
+        r = http().get(
+            f"{keys.wallabag.url}/api/entries", params=query, headers=self.auth
         )
         try:
             entries = r.json()
@@ -85,20 +118,24 @@ class Wallabag(object):
             )
             return
 
-        batch = entries["limit"]
         pages = entries["pages"]
         page = entries["page"]
-        self.archive_batch(entries)
+        complete = self.archive_batch(entries)
         while page < pages:
             page = page + 1
-            paged = {"perPage": batch, "page": page}
-            r = requests.get(
+            query["page"] = page
+            r = http().get(
                 f"{keys.wallabag.url}/api/entries",
-                params=paged,
+                params=query,
                 headers=self.auth,
             )
             entries = r.json()
-            self.archive_batch(entries)
+            complete = self.archive_batch(entries) and complete
+
+        if complete:
+            self.index.setmeta("since", started)
+        else:
+            logging.warning("some wallabag exports failed, syncing them next run")
 
 
 if __name__ == "__main__":
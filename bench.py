@@ -0,0 +1,380 @@
+""" offline end-to-end benchmark
+
+starts a local HTTP server standing in for the HackerNews, Last.fm,
+Artstation and Wallabag APIs and the image CDNs behind them, points the
+silos at it, runs them one by one into a throwaway archive and reports
+throughput, peak memory and per stage timings as JSON
+
+    python3 bench.py --items 500 --latency 0.05 --output bench.json
+    python3 bench.py --compare bench.json -- --metadata-engine native
+
+anything after -- is passed on to settings, the same way run.py gets it
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import struct
+import zlib
+import types
+import shutil
+import argparse
+import resource
+import tempfile
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# a valid 8x8 baseline JPEG; bigger ones are padded with COM segments
+JPEG = bytes.fromhex(
+    "ffd8ffe000104a46494600010100000100010000ffdb004300100b0c0e0c0a100e0d0e12"
+    "11101318281a181616183123251d283a333d3c3933383740485c4e404457453738506d51"
+    "575f626768673e4d71797064785c656763ffdb0043011112121815182f1a1a2f63423842"
+    "636363636363636363636363636363636363636363636363636363636363636363636363"
+    "6363636363636363636363636363ffc00011080008000803012200021101031101ffc400"
+    "1f0000010501010101010100000000000000000102030405060708090a0bffc400b51000"
+    "02010303020403050504040000017d010203000411051221314106135161072271143281"
+    "91a1082342b1c11552d1f02433627282090a161718191a25262728292a3435363738393a"
+    "434445464748494a535455565758595a636465666768696a737475767778797a83848586"
+    "8788898a92939495969798999aa2a3a4a5a6a7a8a9aab2b3b4b5b6b7b8b9bac2c3c4c5c6"
+    "c7c8c9cad2d3d4d5d6d7d8d9dae1e2e3e4e5e6e7e8e9eaf1f2f3f4f5f6f7f8f9faffc400"
+    "1f0100030101010101010101010000000000000102030405060708090a0bffc400b51100"
+    "020102040403040705040400010277000102031104052131061241510761711322328108"
+    "144291a1b1c109233352f0156272d10a162434e125f11718191a262728292a3536373839"
+    "3a434445464748494a535455565758595a636465666768696a737475767778797a828384"
+    "85868788898a92939495969798999aa2a3a4a5a6a7a8a9aab2b3b4b5b6b7b8b9bac2c3c4"
+    "c5c6c7c8c9cad2d3d4d5d6d7d8d9dae2e3e4e5e6e7e8e9eaf2f3f4f5f6f7f8f9faffda00"
+    "0c03010002110311003f00caa28a2b88eb3fffd9"
+)
+
+SILOS = ["hackernews", "lastfm", "artstation", "wallabag"]
+
+
+def synthetic_jpeg(size):
+    """ the tiny JPEG, padded with comment segments up to size bytes """
+    padding = []
+    missing = size - len(JPEG)
+    while missing > 4:
+        chunk = min(missing - 4, 0xFFFD)
+        padding.append(b"\xff\xfe" + struct.pack(">H", chunk + 2) + b"x" * chunk)
+        missing = missing - chunk - 4
+    return JPEG[:20] + b"".join(padding) + JPEG[20:]
+
+
+def synthetic_png(size):
+    """ a PNG of random pixels, stored uncompressed, about size bytes """
+    side = max(1, int(math.sqrt(size / 3)))
+    raw = b"".join(b"\x00" + os.urandom(side * 3) for row in range(side))
+
+    def chunk(ctype, data):
+        crc = zlib.crc32(ctype + data) & 0xFFFFFFFF
+        return struct.pack(">I", len(data)) + ctype + data + struct.pack(">I", crc)
+
+    return b"".join(
+        [
+            b"\x89PNG\r\n\x1a\n",
+            chunk(b"IHDR", struct.pack(">IIBBBBB", side, side, 8, 2, 0, 0, 0)),
+            chunk(b"IDAT", zlib.compress(raw, 0)),
+            chunk(b"IEND", b""),
+        ]
+    )
+
+
+class StandIn(object):
+    """ the fake silo data, shared by every request handler """
+
+    def __init__(self, items, page_size, latency, image_size, images):
+        self.items = items
+        self.page_size = page_size
+        self.latency = latency
+        self.images = images
+        self.jpeg = synthetic_jpeg(image_size)
+        self.png = synthetic_png(image_size)
+        self.epub = os.urandom(image_size)
+        self.base = None
+        self.lock = threading.Lock()
+        self.served = 0
+        self.requests = 0
+
+    @property
+    def pages(self):
+        return max(1, math.ceil(self.items / self.page_size))
+
+    def page(self, query, size=None):
+        size = size or self.page_size
+        page = int(query.get("page", ["1"])[0])
+        start = (page - 1) * size
+        return page, range(start, min(start + size, self.items))
+
+    def hackernews(self, path, query):
+        if path.startswith("/v0/user/"):
+            return {"id": "bench", "submitted": list(range(self.items, 0, -1))}
+        eid = int(path.split("/")[-1].replace(".json", ""))
+        return {
+            "id": eid,
+            "by": "bench",
+            "type": "comment",
+            "time": 1500000000 + eid,
+            "text": "comment %d " % eid * 20,
+        }
+
+    def lastfm(self, path, query):
+        page, ids = self.page(query)
+        now = 1600000000
+        return {
+            "recenttracks": {
+                "@attr": {"page": "%d" % page, "totalPages": "%d" % self.pages},
+                "track": [
+                    {
+                        "date": {"uts": "%d" % (now - i * 180)},
+                        "artist": {"#text": "artist %d" % (i % 50), "mbid": ""},
+                        "album": {"#text": "album %d" % (i % 200), "mbid": ""},
+                        "name": "track %d" % i,
+                        "image": [{"#text": "%s/img/%d.png" % (self.base, i)}],
+                    }
+                    for i in ids
+                ],
+            }
+        }
+
+    def artstation(self, path, query):
+        if path.endswith("/likes.json"):
+            # ASFavs assumes Artstation's fixed 50 likes per page
+            page, ids = self.page(query, 50)
+            return {
+                "total_count": self.items,
+                "data": [
+                    {
+                        "id": i,
+                        "hash_id": "h%06d" % i,
+                        "slug": "artwork-%d" % i,
+                        "title": "Artwork %d ✨" % i,
+                        "permalink": "%s/artwork/h%06d" % (self.base, i),
+                        "published_at": "2019-05-01T10:00:00.000-05:00",
+                        "user": {
+                            "username": "artist%d" % (i % 30),
+                            "permalink": "%s/artist%d" % (self.base, i % 30),
+                        },
+                    }
+                    for i in ids
+                ],
+            }
+        hid = path.split("/")[-1].replace(".json", "")
+        return {
+            "description_html": "<p>%s</p>" % ("lorem ipsum " * 40),
+            "categories": [{"name": "category %d" % c} for c in range(5)],
+            "assets": [
+                {
+                    "asset_type": "image",
+                    "image_url": "%s/img/%s_%d.jpg" % (self.base, hid, n),
+                }
+                for n in range(self.images)
+            ],
+        }
+
+    def wallabag(self, path, query):
+        if path == "/oauth/v2/token":
+            return {"access_token": "bench"}
+        page, ids = self.page(query)
+        return {
+            "limit": self.page_size,
+            "pages": self.pages,
+            "page": page,
+            "_embedded": {
+                "items": [
+                    {"id": i, "url": "https://example.net/article/%d" % i}
+                    for i in ids
+                ]
+            },
+        }
+
+    def route(self, path, query):
+        """ returns (content type, body) for a request """
+        path = "/".join(p for p in path.split("/") if p)
+        path = "/" + path
+        if path.startswith("/img/"):
+            if path.endswith(".png"):
+                return "image/png", self.png
+            return "image/jpeg", self.jpeg
+        if path.endswith("/export.epub"):
+            return "application/epub+zip", self.epub
+        if path.startswith("/v0/"):
+            data = self.hackernews(path, query)
+        elif path.startswith("/2.0"):
+            data = self.lastfm(path, query)
+        elif path.startswith("/oauth/") or path.startswith("/api/"):
+            data = self.wallabag(path, query)
+        else:
+            data = self.artstation(path, query)
+        return "application/json", json.dumps(data).encode("utf-8")
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    standin = None
+
+    def log_message(self, *args):
+        return
+
+    def respond(self):
+        url = urlparse(self.path)
+        if self.standin.latency:
+            time.sleep(self.standin.latency)
+        ctype, body = self.standin.route(url.path, parse_qs(url.query))
+        self.send_response(200)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", "%d" % len(body))
+        self.end_headers()
+        self.wfile.write(body)
+        with self.standin.lock:
+            self.standin.requests = self.standin.requests + 1
+            self.standin.served = self.standin.served + len(body)
+
+    def do_GET(self):
+        self.respond()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.respond()
+
+
+def peak_rss():
+    """ peak resident set size of this process, in bytes """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def compare(result, baseline):
+    for silo, now in result.get("silos").items():
+        before = baseline.get("silos", {}).get(silo)
+        if not before or not before.get("items_per_sec"):
+            continue
+        change = now.get("items_per_sec") / before.get("items_per_sec") - 1
+        print("%-12s %10.1f items/s  %+7.1f%%" % (silo, now.get("items_per_sec"), change * 100))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="offline benchmark for silo.pasta")
+    parser.add_argument("--silos", default=",".join(SILOS))
+    parser.add_argument("--items", default=200, type=int, help="items per silo")
+    parser.add_argument("--page-size", default=50, type=int)
+    parser.add_argument("--latency", default=0.02, type=float, help="seconds per request")
+    parser.add_argument("--image-size", default=256 * 1024, type=int, help="bytes")
+    parser.add_argument("--images", default=3, type=int, help="images per item")
+    parser.add_argument("--output", default=None, help="save results as JSON")
+    parser.add_argument("--compare", default=None, help="earlier results to compare to")
+    args, passthrough = parser.parse_known_args()
+    sys.argv = sys.argv[:1] + [a for a in passthrough if a != "--"]
+
+    standin = StandIn(
+        args.items, args.page_size, args.latency, args.image_size, args.images
+    )
+    Handler.standin = standin
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    standin.base = "http://127.0.0.1:%d" % server.server_port
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    # never let a benchmark anywhere near the real credentials
+    keys = types.ModuleType("keys")
+    keys.hackernews = {"username": "bench"}
+    keys.lastfm = {"username": "bench", "key": "bench"}
+    keys.artstation = {"username": "bench"}
+    sys.modules["keys"] = keys
+
+    import settings
+    keys.wallabag = settings.nameddict(
+        {
+            "url": standin.base,
+            "client_id": "bench",
+            "client_secret": "bench",
+            "username": "bench",
+            "password": "bench",
+        }
+    )
+    archive = tempfile.mkdtemp(prefix="silo-bench-")
+    settings.paths["archive"] = archive
+    settings.paths["bookmarks"] = os.path.join(archive, "bookmarks")
+
+    import common
+    import HackerNews
+    import LastFM
+    import Artstation
+    import Wallabag
+
+    HackerNews.HackerNews.url = "%s/v0/" % standin.base
+    LastFM.LastFM.url = "%s/2.0/" % standin.base
+    Artstation.ASFavs.url = standin.base
+
+    factories = {
+        "hackernews": HackerNews.HackerNews,
+        "lastfm": LastFM.LastFM,
+        "artstation": Artstation.ASFavs,
+        "wallabag": Wallabag.Wallabag,
+    }
+    counters = {
+        "hackernews": lambda: sum(
+            1 for doc in HackerNews.HackerNews().segments.read()
+        ),
+        "lastfm": lambda: max(
+            0, sum(1 for line in open(os.path.join(archive, "lastfm.csv"))) - 1
+        ),
+        "artstation": lambda: sum(
+            1
+            for f in common.favindex().files()
+            if f.endswith(common.MDFEXT)
+        ),
+        "wallabag": lambda: sum(
+            1
+            for f in os.listdir(settings.paths.get("bookmarks"))
+            if f.endswith(".epub")
+        ),
+    }
+
+    result = {
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "params": vars(args),
+        "settings": sys.argv[1:],
+        "silos": {},
+    }
+    try:
+        for name in [s.strip() for s in args.silos.split(",") if s.strip()]:
+            served, requests = standin.served, standin.requests
+            silo = factories[name]()
+            start = time.perf_counter()
+            silo.run()
+            elapsed = time.perf_counter() - start
+            items = counters[name]()
+            stats = {}
+            if getattr(silo, "pipeline", None):
+                stats = {
+                    stage: {"count": count, "seconds": round(total, 4)}
+                    for stage, (count, total) in silo.pipeline.stats.items()
+                }
+            result["silos"][name] = {
+                "seconds": round(elapsed, 4),
+                "items": items,
+                "items_per_sec": round(items / elapsed, 2),
+                "requests": standin.requests - requests,
+                "mb_per_sec": round(
+                    (standin.served - served) / elapsed / 1024 / 1024, 2
+                ),
+                "stages": stats,
+            }
+            print("%-12s %s" % (name, json.dumps(result["silos"][name])))
+    finally:
+        server.shutdown()
+        shutil.rmtree(archive, ignore_errors=True)
+
+    result["peak_rss"] = peak_rss()
+    print("peak RSS: %.1f MB" % (result["peak_rss"] / 1024 / 1024))
+    if args.compare:
+        with open(args.compare) as f:
+            compare(result, json.load(f))
+    if args.output:
+        with open(args.output, "wt") as f:
+            json.dump(result, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,33 @@
 import os
-import glob
-import imghdr
 import re
 import logging
 import shutil
 import subprocess
 import json
+import sqlite3
+import threading
+import time
+import calendar
+import atexit
+import queue
+import hashlib
+import errno
+import struct
+import zlib
+import pickle
+import random
+import itertools
+from heapq import heappush, heapify
+from concurrent.futures import ThreadPoolExecutor
+from bisect import bisect_left
+from operator import methodcaller
+from contextlib import contextmanager, nullcontext
 from io import BytesIO
+from urllib.parse import urlsplit, urlencode
+from email.utils import parsedate_to_datetime
 import lxml.etree as etree
-import requests
-from requests.auth import HTTPBasicAuth
+import asyncio
+import aiohttp
 import arrow
 import settings
 import keys
@@ -45,6 +63,7 @@ NON_URL_SAFE = [
     "\\",
 ]
 # TRANSLATE_TABLE = {ord(char): "" for char in NON_URL_SAFE}
+# str.translate is several times slower than this on non-ASCII text
 RE_NON_URL_SAFE = re.compile(
     r"[{}]".format("".join(re.escape(x) for x in NON_URL_SAFE))
 )
@@ -55,14 +74,37 @@ def slugify(text):
     text = RE_REMOVESCHEME.sub("", text).strip()
     text = RE_NON_URL_SAFE.sub("", text).strip()
     text = text.lower()
-    text = "_".join(re.split(r"\s+", text))
+    text = "_".join(text.split())
     return text
 
 
 
 TMPFEXT = ".xyz"
 MDFEXT = ".md"
+INDEXFNAME = ".index.sqlite"
+RESPONSESFNAME = ".responses.sqlite"
+CHUNKSIZE = 64 * 1024
+RETRIES = 3
+# statuses worth another try, after a while
+RETRY_STATUSES = frozenset([408, 425, 429, 500, 502, 503, 504])
+# there's no point in asking for these again; 415 is what a download
+# that turned out not to be an image gets
+GONE_STATUSES = frozenset([404, 410, 415])
+SNIFFSIZE = 32
+# download priorities, lower goes first
+RECENT = 1
+BACKFILL = 2
+RECENTDAYS = 30
+HEIC_BRANDS = {b"heic", b"heix", b"hevc", b"hevx", b"heim", b"heis", b"mif1"}
+RE_CONTENT_RANGE = re.compile(
+    r"^bytes (?P<start>[0-9]+)-[0-9]+/(?P<total>[0-9]+|\*)$"
+)
 
+LAYOUTS = ["flat", "date", "hash"]
+# states of a fav in the journal; a done fav is in the index instead
+QUEUED = "queued"
+DOWNLOADING = "downloading"
+EMBEDDING = "embedding"
 TMPSUBDIR = "nasg"
 SHM = "/dev/shm"
 
@@ -75,6 +117,44 @@ if not os.path.isdir(TMPDIR):
     os.makedirs(TMPDIR)
 
 
+def atomicwrite(fpath, content):
+    """ write through a temporary file that is synced to disk before
+    it's renamed to fpath, so a crash leaves the old content or the new
+    one, never half of it """
+    tmp = "%s%s" % (fpath, TMPFEXT)
+    with open(tmp, "wb" if isinstance(content, bytes) else "wt") as f:
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, fpath)
+
+
+def closesynced(f):
+    """ close f once everything written to it is on the disk """
+    try:
+        f.flush()
+        os.fsync(f.fileno())
+    finally:
+        f.close()
+
+
+def filesize(fpath):
+    """ the size of fpath, 0 if it isn't there """
+    if os.path.exists(fpath):
+        return os.path.getsize(fpath)
+    return 0
+
+
+def spool(f, hasher, data):
+    hasher.update(data)
+    f.write(data)
+
+
+def discard(fpath):
+    if os.path.exists(fpath):
+        os.remove(fpath)
+
+
 def utfyamldump(data):
     """ dump YAML with actual UTF-8 chars """
     return yaml.dump(
@@ -84,7 +164,7 @@ def utfyamldump(data):
 
 def url2slug(url):
     return slugify(
-        re.sub(r"^https?://(?:www)?", "", url)
+        RE_REMOVESCHEME.sub("", url)
         #only_ascii=True,
         #lower=True,
     )[:200]
@@ -109,9 +189,2099 @@ class cached_property(object):
         return result
 
 
+class Index(object):
+    """ SQLite backed index of everything archived into a directory
+
+    every archive directory (favorite, hn, bookmarks, ...) gets one index
+    file; an item is keyed by the basename of its prefix, and the files
+    belonging to it are stored as attachments, relative to the directory
+
+    a sharded directory keeps its items in subdirectories, laid out by
+    sharddir; the key stays the basename, so an item can be moved
+    between layouts without changing anything else
+
+    with sidecars, only what has a markdown sidecar is an item, and
+    anything else on disk is left over from a run that didn't finish
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS items (
+            key TEXT PRIMARY KEY,
+            silo TEXT NOT NULL,
+            url TEXT,
+            published INTEGER,
+            archived INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS items_silo_archived
+            ON items (silo, archived);
+        CREATE TABLE IF NOT EXISTS attachments (
+            key TEXT NOT NULL,
+            fname TEXT NOT NULL,
+            size INTEGER,
+            mtime INTEGER,
+            PRIMARY KEY (key, fname)
+        );
+        CREATE TABLE IF NOT EXISTS blobs (
+            sha256 TEXT PRIMARY KEY,
+            fname TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS downloads (
+            url TEXT PRIMARY KEY,
+            fname TEXT NOT NULL,
+            etag TEXT,
+            modified TEXT,
+            length INTEGER,
+            complete INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS downloads_fname ON downloads (fname);
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+        CREATE TABLE IF NOT EXISTS journal (
+            key TEXT PRIMARY KEY,
+            prefix TEXT NOT NULL,
+            state TEXT NOT NULL,
+            updated INTEGER NOT NULL
+        );
+    """
+
+    _instances = {}
+    _instances_lock = threading.Lock()
+
+    @classmethod
+    def get(cls, root, silo=None, sharded=False, sidecars=False):
+        """ one shared instance per archive directory """
+        root = os.path.abspath(root)
+        with cls._instances_lock:
+            if root not in cls._instances:
+                cls._instances[root] = cls(root, silo, sharded, sidecars)
+            return cls._instances[root]
+
+    def __init__(self, root, silo=None, sharded=False, sidecars=False):
+        self.root = root
+        self.silo = silo
+        self.sharded = sharded
+        self.sidecars = sidecars
+        self.fpath = os.path.join(root, INDEXFNAME)
+        self.lock = threading.RLock()
+        if not os.path.isdir(root):
+            os.makedirs(root)
+        fresh = not os.path.exists(self.fpath)
+        self.db = sqlite3.connect(
+            self.fpath, timeout=60, check_same_thread=False
+        )
+        self.db.execute("PRAGMA journal_mode=WAL")
+        # WAL is still consistent after a crash with this, it only
+        # skips the fsync on every commit
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(self.SCHEMA)
+        if fresh:
+            self.rebuild()
+
+    def silo_of(self, key):
+        if self.silo:
+            return self.silo
+        return key.split("_")[0]
+
+    def exists(self, key):
+        with self.lock:
+            row = self.db.execute(
+                "SELECT 1 FROM items WHERE key = ?", (key,)
+            ).fetchone()
+        return row is not None
+
+    def since(self, silo):
+        with self.lock:
+            row = self.db.execute(
+                "SELECT MAX(archived) FROM items WHERE silo = ?", (silo,)
+            ).fetchone()
+        return row[0] or 0
+
+    def attachments(self, key):
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT fname FROM attachments WHERE key = ? ORDER BY fname",
+                (key,),
+            ).fetchall()
+        return [r[0] for r in rows]
+
+    def unverified(self, key):
+        """ attachments that are gone or changed size since archiving """
+        broken = []
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT fname, size FROM attachments WHERE key = ?", (key,)
+            ).fetchall()
+        for fname, size in rows:
+            fpath = self.locate(key, fname)
+            if not os.path.exists(fpath) or os.path.getsize(fpath) != size:
+                broken.append(fname)
+        return broken
+
+    def restat(self, fname):
+        """ note the size and mtime of an archived file that was
+        replaced, so it isn't taken for a broken one """
+        st = os.stat(os.path.join(self.root, fname))
+        with self.lock, self.db:
+            self.db.execute(
+                "UPDATE attachments SET size = ?, mtime = ? WHERE fname = ?",
+                (st.st_size, int(st.st_mtime), fname),
+            )
+
+    def locate(self, key, fname):
+        """ the path of an archived file: where the index has it, or
+        where any of the layouts puts it, for a migration that was cut
+        short between moving the file and recording it """
+        fpath = os.path.join(self.root, fname)
+        if os.path.exists(fpath) or not self.sharded:
+            return fpath
+        with self.lock:
+            row = self.db.execute(
+                "SELECT published, archived FROM items WHERE key = ?", (key,)
+            ).fetchone()
+        published = (row[0] or row[1]) if row else 0
+        for layout in LAYOUTS:
+            maybe = os.path.join(
+                self.root, sharddir(key, published, layout), os.path.basename(fname)
+            )
+            if os.path.exists(maybe):
+                return maybe
+        return fpath
+
+    def remove(self, key):
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM items WHERE key = ?", (key,))
+            self.db.execute("DELETE FROM attachments WHERE key = ?", (key,))
+
+    def download(self, url):
+        """ what is known about an earlier transfer of url """
+        with self.lock:
+            row = self.db.execute(
+                "SELECT fname, etag, modified, length, complete "
+                "FROM downloads WHERE url = ?",
+                (url,),
+            ).fetchone()
+        if not row:
+            return None
+        return dict(
+            zip(["fname", "etag", "modified", "length", "complete"], row)
+        )
+
+    def meta(self, key, default=None):
+        """ a value kept between runs, like the time of the last sync """
+        with self.lock:
+            row = self.db.execute(
+                "SELECT value FROM meta WHERE key = ?", (key,)
+            ).fetchone()
+        if not row:
+            return default
+        return json.loads(row[0])
+
+    def setmeta(self, key, value):
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                (key, json.dumps(value)),
+            )
+
+    def transferred(self, transfer):
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO downloads VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    transfer.url,
+                    os.path.relpath(transfer.fpath, self.root),
+                    transfer.etag,
+                    transfer.modified,
+                    transfer.length,
+                    transfer.complete,
+                ),
+            )
+
+    def _add(self, key, url, published, archived, fnames):
+        self.db.execute(
+            "INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?, ?)",
+            (key, self.silo_of(key), url, published, archived),
+        )
+        self.db.execute("DELETE FROM attachments WHERE key = ?", (key,))
+        for fname in fnames:
+            fpath = os.path.join(self.root, fname)
+            try:
+                st = os.stat(fpath)
+                size, mtime = st.st_size, int(st.st_mtime)
+            except FileNotFoundError:
+                size, mtime = None, None
+            self.db.execute(
+                "INSERT INTO attachments VALUES (?, ?, ?, ?)",
+                (key, fname, size, mtime),
+            )
+
+    def add(self, key, url=None, published=None, fnames=[]):
+        """ record an item as archived, along with its files; this is
+        what takes it off the journal """
+        with self.lock, self.db:
+            self._add(key, url, published, int(time.time()), fnames)
+            self.db.execute("DELETE FROM journal WHERE key = ?", (key,))
+
+    def journal(self, key, prefix, state):
+        """ note how far archiving an item got, for recover to know what
+        to do with its files if the run dies before add """
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO journal VALUES (?, ?, ?, ?)",
+                (key, os.path.relpath(prefix, self.root), state, int(time.time())),
+            )
+
+    def recover(self, silo=None):
+        """ clean up after runs of silo that died
+
+        a fav that was queued or downloading keeps the partial files it
+        has a download record for, which the next run resumes, and loses
+        the rest; one that was embedding metadata is rolled back
+        altogether, since its files may be half rewritten, and is
+        downloaded again
+
+        only the directories of journaled favs are looked at, so with an
+        empty journal this is a single query
+        """
+        with self.lock:
+            rows = [
+                row
+                for row in self.db.execute(
+                    "SELECT key, prefix, state FROM journal"
+                ).fetchall()
+                if silo is None or self.silo_of(row[0]) == silo
+            ]
+        listings = {}
+        resumed = 0
+        removed = 0
+        for key, prefix, state in rows:
+            subdir = os.path.dirname(prefix)
+            if subdir not in listings:
+                try:
+                    listings[subdir] = sorted(
+                        os.listdir(os.path.join(self.root, subdir))
+                    )
+                except FileNotFoundError:
+                    listings[subdir] = []
+            fnames = listings[subdir]
+            base = os.path.basename(prefix)
+            dropped = []
+            for sep in [".", "_"]:
+                start = bisect_left(fnames, base + sep)
+                for fname in fnames[start:]:
+                    if not fname.startswith(base + sep):
+                        break
+                    fname = os.path.join(subdir, fname)
+                    if state != EMBEDDING and self.resumable(fname):
+                        resumed = resumed + 1
+                        continue
+                    os.remove(os.path.join(self.root, fname))
+                    dropped.append(fname)
+            with self.lock, self.db:
+                self.db.execute("DELETE FROM journal WHERE key = ?", (key,))
+                for fname in dropped:
+                    if fname.endswith(TMPFEXT):
+                        fname = fname[: -len(TMPFEXT)]
+                    self.db.execute("DELETE FROM downloads WHERE fname = ?", (fname,))
+            logging.info("rolled back %s, which was %s", key, state)
+            removed = removed + len(dropped)
+        if rows:
+            logging.info(
+                "recovered %d unfinished items in %s: %d partial downloads to "
+                "resume, %d files removed",
+                len(rows),
+                self.root,
+                resumed,
+                removed,
+            )
+
+    def resumable(self, fname):
+        """ whether fname is the partial file of an unfinished download """
+        if not fname.endswith(TMPFEXT):
+            return False
+        with self.lock:
+            row = self.db.execute(
+                "SELECT complete FROM downloads WHERE fname = ?",
+                (fname[: -len(TMPFEXT)],),
+            ).fetchone()
+        return row is not None and not row[0]
+
+    def sweep(self):
+        """ remove the temporary files of every run that died, including
+        ones from before the journal; this walks the whole directory """
+        removed = 0
+        for fname in self.files():
+            if not fname.endswith(TMPFEXT) or self.resumable(fname):
+                continue
+            logging.warning("removing %s, left behind by a run that died", fname)
+            os.remove(os.path.join(self.root, fname))
+            removed = removed + 1
+        logging.info("removed %d temporary files from %s", removed, self.root)
+
+    def rebuild(self):
+        """ drop everything and re-populate the index from the files
+
+        items with a markdown sidecar own every file sharing their
+        prefix; any other file is an item on its own
+        """
+        logging.info("rebuilding archive index of %s", self.root)
+        fnames = self.files()
+        items = {}
+        owned = set()
+        for fname in fnames:
+            if not fname.endswith(MDFEXT):
+                continue
+            prefix = fname[: -len(MDFEXT)]
+            key = os.path.basename(prefix)
+            items[key] = []
+            for sep in [".", "_"]:
+                start = bisect_left(fnames, prefix + sep)
+                for maybe in fnames[start:]:
+                    if not maybe.startswith(prefix + sep):
+                        break
+                    items[key].append(maybe)
+            owned.update(items[key])
+        for fname in fnames:
+            if fname in owned or fname.endswith(TMPFEXT):
+                continue
+            if self.sidecars:
+                logging.warning("%s has no sidecar, not indexing it", fname)
+                continue
+            items[os.path.splitext(os.path.basename(fname))[0]] = [fname]
+
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM items")
+            self.db.execute("DELETE FROM attachments")
+            for key, files in items.items():
+                archived = max(
+                    int(os.path.getmtime(os.path.join(self.root, f)))
+                    for f in files
+                )
+                self._add(key, None, None, archived, files)
+        logging.info(
+            "archive index of %s has %d items", self.root, len(items)
+        )
+
+    def files(self):
+        """ every archived file, relative to the directory, sorted """
+        if not self.sharded:
+            return sorted(
+                fname
+                for fname in os.listdir(self.root)
+                if not fname.startswith(INDEXFNAME)
+                and os.path.isfile(os.path.join(self.root, fname))
+            )
+        fnames = []
+        for dirpath, dirnames, files in os.walk(self.root):
+            dirnames[:] = [d for d in dirnames if not d.startswith(".")]
+            subdir = os.path.relpath(dirpath, self.root)
+            fnames.extend(
+                os.path.normpath(os.path.join(subdir, fname))
+                for fname in files
+                if not fname.startswith(INDEXFNAME)
+            )
+        return sorted(fnames)
+
+    def migrate(self, layout, limit=0):
+        """ move archived items into the directories of layout
+
+        an item is moved and recorded before the next one is touched, so
+        this can run next to the archiver, be stopped at any time, and
+        picks up where it was left when started again; with limit only
+        that many items are moved
+        """
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT key, published, archived FROM items ORDER BY key"
+            ).fetchall()
+        moved = 0
+        for key, published, archived in rows:
+            if limit and moved >= limit:
+                break
+            fnames = self.attachments(key)
+            if not published and layout == "date":
+                published = self.sidecardate(key, fnames)
+                if published:
+                    with self.lock, self.db:
+                        self.db.execute(
+                            "UPDATE items SET published = ? WHERE key = ?",
+                            (published, key),
+                        )
+            subdir = sharddir(key, published or archived, layout)
+            if all(os.path.dirname(fname) == subdir for fname in fnames):
+                continue
+            if not os.path.isdir(os.path.join(self.root, subdir)):
+                os.makedirs(os.path.join(self.root, subdir))
+            renames = []
+            for fname in fnames:
+                src = self.locate(key, fname)
+                target = os.path.join(subdir, os.path.basename(fname))
+                dst = os.path.join(self.root, target)
+                if src != dst and os.path.exists(src):
+                    os.replace(src, dst)
+                    try:
+                        os.removedirs(os.path.dirname(src))
+                    except OSError:
+                        pass
+                renames.append((target, fname))
+            with self.lock, self.db:
+                for target, fname in renames:
+                    self.db.execute(
+                        "UPDATE attachments SET fname = ? WHERE key = ? AND fname = ?",
+                        (target, key, fname),
+                    )
+                    self.db.execute(
+                        "UPDATE downloads SET fname = ? WHERE fname = ?",
+                        (target, fname),
+                    )
+            logging.debug("moved %s to %s", key, subdir or ".")
+            moved = moved + 1
+        logging.info("moved %d items of %s to the %s layout", moved, self.root, layout)
+        return moved
+
+    def sidecardate(self, key, fnames):
+        """ the date in the markdown sidecar of an item, for items that
+        were indexed from the files alone """
+        for fname in fnames:
+            if fname.endswith(MDFEXT):
+                break
+        else:
+            return None
+        try:
+            with open(self.locate(key, fname), "rt") as f:
+                meta = next(yaml.safe_load_all(f))
+            return calendar.timegm(arrow.get(meta.get("date")).utctimetuple())
+        except Exception as e:
+            logging.warning("no date in the sidecar of %s: %s", key, e)
+            return None
+
+
+def sharddir(key, published, layout):
+    """ the subdirectory an item goes into, relative to its archive
+    directory: nothing for flat, silo/yyyy/mm of its publish time for
+    date, and the first two hex digits of the SHA-1 of its key for
+    hash, which spreads items evenly across 256 directories """
+    if layout == "date":
+        t = time.gmtime(published or 0)
+        return os.path.join(
+            key.split("_")[0], "%04d" % t.tm_year, "%02d" % t.tm_mon
+        )
+    if layout == "hash":
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()[:2]
+    return ""
+
+
+def imagetype(head):
+    """ tell the image type from the first bytes of a file, named after
+    the extension it gets """
+    if head.startswith(b"\xff\xd8\xff"):
+        return "jpeg"
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "png"
+    if head[:6] in (b"GIF87a", b"GIF89a"):
+        return "gif"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "webp"
+    if head[4:8] == b"ftyp":
+        brands = [head[i : i + 4] for i in range(8, min(len(head), 32), 4)]
+        if b"avif" in brands or b"avis" in brands:
+            return "avif"
+        if set(brands) & HEIC_BRANDS:
+            return "heic"
+    if head[:4] in (b"II*\x00", b"MM\x00*"):
+        return "tiff"
+    if head[:2] == b"BM":
+        return "bmp"
+    return None
+
+
+def parse_content_range(value):
+    """ "bytes 100-199/200" -> (100, 200); total is None for "*" """
+    match = RE_CONTENT_RANGE.match(value or "")
+    if not match:
+        return None, None
+    total = match.group("total")
+    return int(match.group("start")), int(total) if total != "*" else None
+
+
+class Response(object):
+    """ the parts of a finished HTTP response the silos care about """
+
+    def __init__(self, url, status_code, headers, content):
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8", errors="replace")
+
+    def json(self):
+        return json.loads(self.content)
+
+
+class ResponseCache(object):
+    """ on-disk cache of API responses, keyed by URL
+
+    re-runs and runs after a crash take metadata from here instead of
+    repeating requests made less than ttl seconds ago; get and set follow
+    the Django cache API, which flickr_api takes for its own requests
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS responses (
+            key TEXT PRIMARY KEY,
+            value BLOB NOT NULL,
+            expires INTEGER NOT NULL
+        );
+    """
+
+    def __init__(self, fpath, ttl):
+        self.fpath = fpath
+        self.ttl = ttl
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(fpath, timeout=60, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(self.SCHEMA)
+        with self.db:
+            self.db.execute(
+                "DELETE FROM responses WHERE expires <= ?", (int(time.time()),)
+            )
+
+    @staticmethod
+    def key(url, params=None):
+        if not params:
+            return url
+        return "%s?%s" % (url, urlencode(sorted(params.items())))
+
+    def get(self, key, default=None):
+        with self.lock:
+            row = self.db.execute(
+                "SELECT value FROM responses WHERE key = ? AND expires > ?",
+                (key, int(time.time())),
+            ).fetchone()
+        if not row:
+            return default
+        return pickle.loads(row[0])
+
+    def set(self, key, value, timeout=None):
+        expires = int(time.time()) + (timeout or self.ttl)
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?)",
+                (key, pickle.dumps(value), expires),
+            )
+
+
+_responses = None
+_responses_lock = threading.Lock()
+
+
+def responses():
+    """ the shared response cache, None unless --cache-ttl is set """
+    global _responses
+    if not settings.args.get("cache_ttl"):
+        return None
+    with _responses_lock:
+        if not _responses:
+            _responses = ResponseCache(
+                os.path.join(settings.paths.get("archive"), RESPONSESFNAME),
+                int(settings.args.get("cache_ttl")),
+            )
+        return _responses
+
+
+class Transfer(object):
+    """ the outcome of streaming a URL into a file """
+
+    def __init__(self, url, fpath, etag=None, modified=None):
+        self.url = url
+        self.fpath = fpath
+        self.etag = etag
+        self.modified = modified
+        self.length = None
+        self.status = None
+        self.sha256 = None
+        self.imgtype = None
+
+    @property
+    def complete(self):
+        return self.status == 200
+
+    @property
+    def partial(self):
+        """ where the file is until it's complete """
+        return "%s%s" % (self.fpath, TMPFEXT)
+
+
+class RateLimit(object):
+    """ spaces out coroutines on the HTTP loop to at most rate calls of
+    wait() per second """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self.next = 0.0
+        self.lock = None
+
+    async def wait(self):
+        if not self.interval:
+            return
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            now = time.monotonic()
+            if self.next > now:
+                await asyncio.sleep(self.next - now)
+                now = self.next
+            self.next = now + self.interval
+
+
+class HostUnavailable(aiohttp.ClientError):
+    """ the circuit breaker of a host is open """
+
+
+def retryafter(value):
+    """ seconds from a Retry-After header, which is either a number of
+    seconds or an HTTP date """
+    if not value:
+        return 0
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return 0
+
+
+def backoff(attempt, base=1.0, cap=60.0):
+    """ exponential backoff with full jitter """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class HostLimit(object):
+    """ what one host tolerates: a token bucket for the request rate,
+    a retry budget and a circuit breaker
+
+    the rate starts at the configured maximum, is halved when the host
+    pushes back with 429 or 503, at most once every HALVING seconds so
+    a burst of requests already in flight counts as one push, and then
+    grows back slowly with every success; an unlimited host starts
+    halving from UNLIMITED and is unlimited again once it grows back
+    to that; Retry-After pauses the host altogether; retries may not
+    exceed a share of the requests made, so a struggling host isn't
+    hit with a retry storm; after BREAKER failures in a row requests to
+    it fail right away for COOLDOWN seconds, after which a single probe
+    is let through and the rest keep failing until it tells whether
+    the host is back
+    """
+
+    MINRATE = 0.2
+    UNLIMITED = 20.0
+    INCREASE = 0.05
+    HALVING = 5
+    BUDGET = 0.2
+    MINRETRIES = 10
+    BREAKER = 5
+    COOLDOWN = 60
+
+    def __init__(self, host, rate, burst):
+        self.host = host
+        self.maxrate = rate
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.paused = 0.0
+        self.halved = 0.0
+        self.broken = 0.0
+        self.probing = False
+        self.failures = 0
+        self.requests = 0
+        self.retries = 0
+
+    async def acquire(self):
+        now = time.monotonic()
+        if now < self.broken:
+            raise HostUnavailable("%s is failing, not trying it for now" % self.host)
+        if self.broken:
+            # this one is the probe; the breaker stays open for the rest
+            # until it tells, or for another cooldown if it never does
+            self.broken = now + self.COOLDOWN
+            self.probing = True
+        while True:
+            now = time.monotonic()
+            if now < self.paused:
+                await asyncio.sleep(self.paused - now)
+                continue
+            if not self.rate:
+                break
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens = self.tokens - 1
+                break
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+        self.requests = self.requests + 1
+
+    def retry(self):
+        """ whether the retry budget allows one more """
+        if self.retries >= self.MINRETRIES + self.BUDGET * self.requests:
+            return False
+        self.retries = self.retries + 1
+        metrics().inc("http_retries_total", host=self.host)
+        return True
+
+    def closed(self):
+        """ the probe got an answer, the host is back """
+        if self.probing:
+            logging.info("%s is back", self.host)
+            self.probing = False
+            self.broken = 0.0
+
+    def succeeded(self):
+        self.failures = 0
+        self.closed()
+        if self.rate and self.rate != self.maxrate:
+            self.rate = self.rate + self.INCREASE
+            if self.rate >= (self.maxrate or self.UNLIMITED):
+                self.rate = self.maxrate
+
+    def throttled(self, delay):
+        logging.warning(
+            "%s asked to slow down, pausing %.1fs", self.host, delay
+        )
+        metrics().inc("http_throttled_total", host=self.host)
+        self.closed()
+        now = time.monotonic()
+        self.paused = max(self.paused, now + delay)
+        if now - self.halved < self.HALVING:
+            return
+        self.halved = now
+        self.rate = max(self.MINRATE, (self.rate or self.UNLIMITED) / 2)
+
+    def failed(self):
+        self.failures = self.failures + 1
+        self.probing = False
+        if self.failures >= self.BREAKER:
+            logging.error(
+                "%s failed %d times in a row, pausing it for %ds",
+                self.host,
+                self.failures,
+                self.COOLDOWN,
+            )
+            self.broken = time.monotonic() + self.COOLDOWN
+
+    async def wait(self, attempt, r=None):
+        """ note a failed attempt and sleep before the next one; False if
+        there shouldn't be one """
+        delay = backoff(attempt)
+        if r is not None and r.status in (429, 503):
+            delay = max(delay, retryafter(r.headers.get("Retry-After")))
+            self.throttled(delay)
+        else:
+            self.failed()
+        if attempt >= RETRIES or not self.retry():
+            return False
+        if time.monotonic() + delay < self.broken:
+            return False
+        await asyncio.sleep(delay)
+        return True
+
+
+class Bucket(object):
+    """ bytes per second; taking more than there is goes into debt,
+    which is paid back by sleeping, so chunks of any size are paced """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def charge(self, nbytes):
+        self.refill()
+        self.tokens = self.tokens - nbytes
+
+    async def take(self, nbytes):
+        self.charge(nbytes)
+        if self.tokens < 0:
+            await asyncio.sleep(-self.tokens / self.rate)
+
+
+class Bandwidth(object):
+    """ download budget shared by every silo: a global cap and optional
+    caps per silo, in bytes per second, 0 meaning no cap
+
+    downloads ask for every chunk they received; whoever has the lowest
+    priority number gets the global budget first, so recent favs are
+    archived ahead of backfill; API responses are only charged, never
+    held back, so paging goes on while downloads wait
+
+    the budget is tight when the downloads under way announced more
+    bytes than it lets through in TIGHT seconds
+    """
+
+    TIGHT = 30
+
+    def __init__(self, total, silos):
+        self.total = Bucket(total) if total else None
+        self.silos = {silo: Bucket(rate) for silo, rate in silos.items() if rate}
+        self.expected = {}
+        self.waiting = []
+        self.tickets = itertools.count()
+        self.moved = None
+
+    @property
+    def enabled(self):
+        return bool(self.total or self.silos)
+
+    def buckets(self, silo=None):
+        return [b for b in (self.total, self.silos.get(silo)) if b]
+
+    def tight(self, silo=None):
+        """ whether downloads are queueing up behind the budget """
+        if self.total:
+            if sum(list(self.expected.values())) > self.total.rate * self.TIGHT:
+                return True
+        if silo in self.silos:
+            return self.expected.get(silo, 0) > self.silos[silo].rate * self.TIGHT
+        return False
+
+    def expect(self, nbytes, silo=None):
+        """ note the length of a download that's starting, or take back
+        what's left of it with a negative one """
+        if self.enabled:
+            self.expected[silo] = max(0, self.expected.get(silo, 0) + nbytes)
+
+    def charge(self, nbytes, silo=None):
+        for bucket in self.buckets(silo):
+            bucket.charge(nbytes)
+
+    async def take(self, nbytes, priority=BACKFILL, silo=None):
+        if not self.enabled:
+            return
+        self.expect(-nbytes, silo)
+        start = time.monotonic()
+        if silo in self.silos:
+            await self.silos[silo].take(nbytes)
+        if self.total:
+            if self.moved is None:
+                self.moved = asyncio.Event()
+            ticket = (priority, next(self.tickets))
+            heappush(self.waiting, ticket)
+            try:
+                while self.waiting[0] != ticket:
+                    await self.moved.wait()
+                await self.total.take(nbytes)
+            finally:
+                self.waiting.remove(ticket)
+                heapify(self.waiting)
+                moved, self.moved = self.moved, asyncio.Event()
+                moved.set()
+        metrics().inc(
+            "bandwidth_wait_seconds_total",
+            time.monotonic() - start,
+            silo=silo or "none",
+        )
+
+
+class HTTP(object):
+    """ asyncio HTTP client shared by every silo
+
+    a single event loop runs in a background thread with one pooled
+    aiohttp session; synchronous code calls get/post, which block on
+    the loop, while code that wants many requests in flight submits
+    the coroutines directly and collects the futures
+
+    files and the index are only touched from the disk threads, so a
+    slow disk or a busy index never holds up the loop
+    """
+
+    def __init__(self, limit, per_host, timeout, rate):
+        self.limit = limit
+        self.per_host = per_host
+        self.timeout = timeout
+        self.rate = rate
+        self.hosts = {}
+        self.disk = ThreadPoolExecutor(
+            max_workers=max(1, limit), thread_name_prefix="disk"
+        )
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(
+            target=self.loop.run_forever, name="http", daemon=True
+        )
+        self.thread.start()
+        self.session = self.call(self.connect())
+        atexit.register(self.stop)
+
+    async def connect(self):
+        return aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=self.limit, limit_per_host=self.per_host
+            ),
+            timeout=aiohttp.ClientTimeout(
+                total=None, connect=self.timeout, sock_read=self.timeout
+            ),
+        )
+
+    def submit(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def call(self, coro):
+        return self.submit(coro).result()
+
+    def ondisk(self, func, *args):
+        """ run func in a disk thread; await the result on the loop """
+        return self.loop.run_in_executor(self.disk, func, *args)
+
+    def hostlimit(self, url):
+        """ the limits of the host of url; only used on the loop """
+        host = urlsplit(url).hostname
+        if host not in self.hosts:
+            self.hosts[host] = HostLimit(host, self.rate, self.per_host)
+        return self.hosts[host]
+
+    def account(self, url, received, elapsed):
+        if not metrics().enabled:
+            return
+        host = urlsplit(url).hostname
+        metrics().inc("http_requests_total", host=host)
+        metrics().inc("http_bytes_total", received, host=host)
+        metrics().observe("http_request_seconds", elapsed, host=host)
+
+    async def request(self, method, url, retry_on=RETRY_STATUSES, **kwargs):
+        """ the response, retried within the limits of the host when it
+        fails or comes back with a status in retry_on; the last response
+        is returned once retrying is over """
+        limit = self.hostlimit(url)
+        for attempt in range(RETRIES + 1):
+            await limit.acquire()
+            start = time.perf_counter()
+            try:
+                async with self.session.request(method, url, **kwargs) as r:
+                    content = await r.read()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logging.warning("requesting %s failed: %s", url, e)
+                if not await limit.wait(attempt):
+                    raise
+                continue
+            self.account(url, len(content), time.perf_counter() - start)
+            bandwidth().charge(len(content))
+            response = Response("%s" % r.url, r.status, r.headers.copy(), content)
+            if r.status not in retry_on:
+                limit.succeeded()
+                return response
+            logging.warning("requesting %s returned %d", url, r.status)
+            if not await limit.wait(attempt, r):
+                return response
+
+    async def fetch(
+        self,
+        url,
+        fpath,
+        headers=None,
+        resume=None,
+        sniff=False,
+        priority=BACKFILL,
+        silo=None,
+        started=None,
+    ):
+        """ stream url into fpath and check the received length
+
+        the body goes into a temporary file, synced and renamed to fpath
+        once it's complete, so fpath is never a partial file
+
+        a transfer that breaks off is continued with a Range request,
+        guarded by If-Range so a changed file starts over; passing the
+        download record of an earlier run as resume picks up the
+        partial file it left behind
+
+        with sniff, fpath is only a template: the type of the image is
+        told from the first bytes of the body, the file is written
+        straight under its final extension, and anything that isn't an
+        image is dropped before a single byte is saved
+
+        every chunk is paid for from the bandwidth budget of silo at
+        the given priority before the next one is read
+
+        started is called with the transfer once the response headers
+        are in and before anything is written, so whatever it records
+        about the partial file outlives a run that dies mid-transfer
+        """
+        logging.info("pulling %s to %s", url, fpath)
+        transfer = Transfer(url, fpath)
+        if resume:
+            transfer.fpath = resume.get("fpath", fpath)
+            transfer.etag = resume.get("etag")
+            transfer.modified = resume.get("modified")
+            transfer.length = resume.get("length")
+            if sniff:
+                transfer.imgtype = os.path.splitext(transfer.fpath)[1][1:]
+        hasher = None
+        limit = self.hostlimit(url)
+        for attempt in range(RETRIES + 1):
+            try:
+                await limit.acquire()
+            except HostUnavailable as e:
+                logging.warning("not pulling %s: %s", url, e)
+                break
+            offset = 0
+            if attempt or (resume and (transfer.etag or transfer.modified)):
+                offset = await self.ondisk(filesize, transfer.partial)
+            rheaders = dict(headers or {})
+            if offset:
+                rheaders["Range"] = "bytes=%d-" % offset
+                if transfer.etag or transfer.modified:
+                    rheaders["If-Range"] = transfer.etag or transfer.modified
+            began = time.perf_counter()
+            received = 0
+            expected = 0
+            try:
+                async with self.session.get(url, headers=rheaders) as r:
+                    if r.status == 206 and offset:
+                        start, total = parse_content_range(
+                            r.headers.get("Content-Range")
+                        )
+                        if start != offset:
+                            logging.warning("bogus range response from %s", url)
+                            await self.ondisk(os.truncate, transfer.partial, 0)
+                            continue
+                        mode = "ab"
+                        transfer.length = total
+                    elif r.status == 416 and offset:
+                        limit.succeeded()
+                        if offset == transfer.length:
+                            # every byte was in by the time the last
+                            # run died, it only didn't get to rename
+                            hasher = await self.ondisk(contenthash, transfer.partial)
+                            await self.ondisk(
+                                os.replace, transfer.partial, transfer.fpath
+                            )
+                            transfer.sha256 = hasher.hexdigest()
+                            transfer.status = 200
+                            return transfer
+                        logging.warning(
+                            "%s has no byte %d, starting over", url, offset
+                        )
+                        await self.ondisk(os.truncate, transfer.partial, 0)
+                        continue
+                    elif r.status == 200:
+                        mode = "wb"
+                        transfer.etag = r.headers.get("ETag")
+                        transfer.modified = r.headers.get("Last-Modified")
+                        transfer.length = None
+                        if r.headers.get("Content-Encoding", "identity") == "identity":
+                            transfer.length = r.content_length
+                    elif r.status in RETRY_STATUSES:
+                        logging.warning("pulling %s returned %d", url, r.status)
+                        r.release()
+                        if await limit.wait(attempt, r):
+                            continue
+                        transfer.status = r.status
+                        return transfer
+                    else:
+                        logging.error(
+                            "pulling %s failed with status %d", url, r.status
+                        )
+                        transfer.status = r.status
+                        return transfer
+                    if transfer.length:
+                        expected = transfer.length - (offset if mode == "ab" else 0)
+                        bandwidth().expect(expected, silo)
+                    chunks = r.content.iter_chunked(CHUNKSIZE)
+                    head = b""
+                    if sniff and mode == "wb":
+                        async for chunk in chunks:
+                            head = head + chunk
+                            if len(head) >= SNIFFSIZE:
+                                break
+                        imgtype = imagetype(head)
+                        metrics().inc("images_total", type=imgtype or "none")
+                        if not imgtype:
+                            logging.warning("%s is not an image, dropping it", url)
+                            transfer.status = 415
+                            return transfer
+                        target = "%s.%s" % (os.path.splitext(fpath)[0], imgtype)
+                        if transfer.fpath != target:
+                            await self.ondisk(discard, transfer.partial)
+                        transfer.fpath = target
+                        transfer.imgtype = imgtype
+                    if started:
+                        await self.ondisk(started, transfer)
+                    if mode == "wb" or hasher is None:
+                        hasher = ContentHash()
+                        if mode == "ab":
+                            await self.ondisk(contenthash, transfer.partial, hasher)
+                    f = await self.ondisk(open, transfer.partial, mode)
+                    try:
+                        await self.ondisk(spool, f, hasher, head)
+                        received = len(head)
+                        if head:
+                            await bandwidth().take(len(head), priority, silo)
+                        async for chunk in chunks:
+                            await self.ondisk(spool, f, hasher, chunk)
+                            received = received + len(chunk)
+                            await bandwidth().take(len(chunk), priority, silo)
+                    finally:
+                        await self.ondisk(closesynced, f)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logging.warning("pulling %s broke off: %s", url, e)
+                if await limit.wait(attempt):
+                    continue
+                break
+            finally:
+                self.account(url, received, time.perf_counter() - began)
+                if received < expected:
+                    bandwidth().expect(received - expected, silo)
+            limit.succeeded()
+            have = await self.ondisk(filesize, transfer.partial)
+            if transfer.length is None or have == transfer.length:
+                await self.ondisk(os.replace, transfer.partial, transfer.fpath)
+                transfer.sha256 = hasher.hexdigest()
+                transfer.status = 200
+                return transfer
+            logging.warning(
+                "pulling %s stopped at %d of %d bytes", url, have, transfer.length
+            )
+        transfer.status = 206
+        return transfer
+
+    async def check(self, url, etag=None, modified=None, headers=None):
+        """ conditional request for something archived earlier; returns
+        the status without reading the body, 304 meaning unchanged """
+        rheaders = dict(headers or {})
+        if etag:
+            rheaders["If-None-Match"] = etag
+        if modified:
+            rheaders["If-Modified-Since"] = modified
+        await self.hostlimit(url).acquire()
+        async with self.session.get(url, headers=rheaders) as r:
+            return r.status
+
+    def get(self, url, cache=False, **kwargs):
+        """ with cache, a successful response is kept in and served from
+        the response cache, if there is one """
+        if not cache or not responses():
+            return self.call(self.request("GET", url, **kwargs))
+        key = responses().key(url, kwargs.get("params"))
+        response = responses().get(key)
+        if response:
+            metrics().inc("http_cache_hits_total", host=urlsplit(url).hostname)
+            return response
+        response = self.call(self.request("GET", url, **kwargs))
+        if response.status_code == 200:
+            responses().set(key, response)
+        return response
+
+    def post(self, url, **kwargs):
+        return self.call(self.request("POST", url, **kwargs))
+
+    def stop(self):
+        if not self.loop.is_running():
+            return
+        self.call(self.session.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.disk.shutdown(wait=False)
+
+
+_http = None
+_http_lock = threading.Lock()
+
+
+def http():
+    global _http
+    with _http_lock:
+        if not _http:
+            _http = HTTP(
+                int(settings.args.get("workers")),
+                int(settings.args.get("per_host")),
+                int(settings.args.get("timeout")),
+                float(settings.args.get("rate")),
+            )
+        return _http
+
+
+_bandwidth = None
+_bandwidth_lock = threading.Lock()
+
+
+def bandwidth():
+    global _bandwidth
+    with _bandwidth_lock:
+        if not _bandwidth:
+            silos = {}
+            for cap in settings.args.get("silo_bandwidth").split(","):
+                if not cap.strip():
+                    continue
+                silo, rate = cap.split("=")
+                silos[silo.strip().lower()] = int(rate) * 1024
+            _bandwidth = Bandwidth(int(settings.args.get("bandwidth")) * 1024, silos)
+        return _bandwidth
+
+
+def exifescape(value):
+    """ C style escaping of tag values, so multiline text survives the
+    line based -@ argument file; exiftool undoes it because of -ec """
+    value = "%s" % value
+    return (
+        value.replace("\\", "\\\\")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+        .replace("\t", "\\t")
+    )
+
+
+XMPNS = {
+    "x": "adobe:ns:meta/",
+    "rdf": "http://www.w3.org/1999/02/22-rdf-syntax-ns#",
+    "dc": "http://purl.org/dc/elements/1.1/",
+    "pdf": "http://ns.adobe.com/pdf/1.3/",
+    "photoshop": "http://ns.adobe.com/photoshop/1.0/",
+    "xmpDM": "http://ns.adobe.com/xmp/1.0/DynamicMedia/",
+    "lr": "http://ns.adobe.com/lightroom/1.0/",
+}
+XMPSIG = b"http://ns.adobe.com/xap/1.0/\x00"
+PNGSIG = b"\x89PNG\r\n\x1a\n"
+PNGXMPKEY = b"XML:com.adobe.xmp"
+
+
+class XMP(object):
+    """ in-process writer for the XMP properties write_exif sets with
+    exiftool: the packet goes into an APP1 segment of a JPEG or an iTXt
+    chunk of a PNG; an XMP packet already in the file is kept, with our
+    properties replacing its own
+
+    exiftool writes GPS coordinates as EXIF tags, which this can't, so
+    write_exif leaves favs with coordinates to exiftool
+    """
+
+    FORMATS = ["jpeg", "png"]
+
+    def __init__(self, copyright, source, released, headline, description, subjects):
+        self.copyright = copyright
+        self.source = source
+        self.released = released
+        self.headline = headline
+        self.description = description
+        self.subjects = subjects
+
+    @staticmethod
+    def qname(name):
+        prefix, local = name.split(":")
+        return "{%s}%s" % (XMPNS[prefix], local)
+
+    def properties(self):
+        """ (name, kind, value) of everything we write """
+        props = [
+            ("pdf:Copyright", "text", self.copyright),
+            ("dc:source", "text", self.source),
+            ("xmpDM:releaseDate", "text", self.released),
+            ("photoshop:Headline", "text", self.headline),
+            ("dc:description", "alt", self.description),
+            ("lr:hierarchicalSubject", "bag", self.subjects),
+            ("dc:subject", "bag", self.subjects),
+        ]
+        return props
+
+    def packet(self, existing=None):
+        rdf = None
+        if existing:
+            try:
+                root = etree.fromstring(existing)
+                rdf = root.find(".//" + self.qname("rdf:RDF"))
+            except etree.XMLSyntaxError as e:
+                logging.warning("dropping unparseable XMP packet: %s", e)
+        if rdf is None:
+            root = etree.Element(self.qname("x:xmpmeta"), nsmap={"x": XMPNS["x"]})
+            rdf = etree.SubElement(root, self.qname("rdf:RDF"), nsmap=XMPNS)
+
+        props = self.properties()
+        ours = set(self.qname(name) for name, kind, value in props)
+        for desc in rdf.findall(self.qname("rdf:Description")):
+            for attr in list(desc.attrib):
+                if attr in ours:
+                    del desc.attrib[attr]
+            for child in list(desc):
+                if child.tag in ours:
+                    desc.remove(child)
+            if not len(desc) and set(desc.attrib) <= {self.qname("rdf:about")}:
+                rdf.remove(desc)
+
+        desc = etree.SubElement(
+            rdf, self.qname("rdf:Description"), nsmap=XMPNS
+        )
+        desc.set(self.qname("rdf:about"), "")
+        for name, kind, value in props:
+            el = etree.SubElement(desc, self.qname(name))
+            if kind == "text":
+                el.text = "%s" % value
+            elif kind == "alt":
+                li = etree.SubElement(
+                    etree.SubElement(el, self.qname("rdf:Alt")),
+                    self.qname("rdf:li"),
+                )
+                li.set("{http://www.w3.org/XML/1998/namespace}lang", "x-default")
+                li.text = "%s" % value
+            else:
+                bag = etree.SubElement(el, self.qname("rdf:Bag"))
+                for item in value:
+                    etree.SubElement(bag, self.qname("rdf:li")).text = "%s" % item
+
+        return b"".join(
+            [
+                '<?xpacket begin="\ufeff" id="W5M0MpCehiHzreSzNTczkc9d"?>\n'.encode(
+                    "utf-8"
+                ),
+                etree.tostring(root, encoding="utf-8"),
+                b'\n<?xpacket end="w"?>',
+            ]
+        )
+
+    def jpeg(self, data):
+        if data[:2] != b"\xff\xd8":
+            raise ValueError("not a JPEG file")
+        head = []
+        existing = None
+        insert = 0
+        pos = 2
+        while True:
+            if pos + 4 > len(data) or data[pos] != 0xFF:
+                raise ValueError("broken JPEG segment at %d" % pos)
+            marker = data[pos + 1]
+            if marker == 0xFF:
+                pos = pos + 1
+                continue
+            if marker in (0xDA, 0xD9):
+                break
+            length = struct.unpack(">H", data[pos + 2 : pos + 4])[0]
+            segment = data[pos : pos + 2 + length]
+            pos = pos + 2 + length
+            if marker == 0xE1 and segment[4:].startswith(XMPSIG):
+                existing = segment[4 + len(XMPSIG) :]
+                continue
+            head.append(segment)
+            if marker in (0xE0, 0xE1) and insert == len(head) - 1:
+                insert = len(head)
+
+        payload = XMPSIG + self.packet(existing)
+        if len(payload) + 2 > 0xFFFF:
+            raise ValueError("XMP packet too large for a JPEG segment")
+        segment = b"\xff\xe1" + struct.pack(">H", len(payload) + 2) + payload
+        head.insert(insert, segment)
+        return b"\xff\xd8" + b"".join(head) + data[pos:]
+
+    def png(self, data):
+        if not data.startswith(PNGSIG):
+            raise ValueError("not a PNG file")
+        chunks = []
+        existing = None
+        insert = None
+        pos = len(PNGSIG)
+        while pos < len(data):
+            if pos + 12 > len(data):
+                raise ValueError("broken PNG chunk at %d" % pos)
+            length = struct.unpack(">I", data[pos : pos + 4])[0]
+            ctype = data[pos + 4 : pos + 8]
+            chunk = data[pos : pos + 12 + length]
+            pos = pos + 12 + length
+            if ctype == b"iTXt" and chunk[8:].startswith(PNGXMPKEY + b"\x00"):
+                fields = chunk[8 + len(PNGXMPKEY) + 1 : -4]
+                if fields[:1] == b"\x00":
+                    existing = fields[2:].split(b"\x00", 2)[-1]
+                continue
+            if ctype == b"IDAT" and insert is None:
+                insert = len(chunks)
+            chunks.append(chunk)
+        if insert is None:
+            raise ValueError("PNG without image data")
+
+        body = PNGXMPKEY + b"\x00\x00\x00\x00\x00" + self.packet(existing)
+        chunk = b"".join(
+            [
+                struct.pack(">I", len(body)),
+                b"iTXt",
+                body,
+                struct.pack(">I", zlib.crc32(b"iTXt" + body) & 0xFFFFFFFF),
+            ]
+        )
+        chunks.insert(insert, chunk)
+        return PNGSIG + b"".join(chunks)
+
+    def write(self, fpath, imgtype):
+        with open(fpath, "rb") as f:
+            data = f.read()
+        atomicwrite(fpath, getattr(self, imgtype)(data))
+
+
+class ExifTool(object):
+    """ a single long running exiftool process, fed over -stay_open """
+
+    def __init__(self):
+        self.proc = None
+        self.counter = 0
+
+    def start(self):
+        self.proc = subprocess.Popen(
+            ["exiftool", "-stay_open", "True", "-@", "-"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            encoding="utf-8",
+            errors="replace",
+        )
+
+    def readuntil(self, stream, marker):
+        lines = []
+        for line in stream:
+            line = line.rstrip("\n")
+            if line == marker:
+                return lines
+            lines.append(line)
+        raise EOFError("exiftool exited unexpectedly")
+
+    def execute(self, params):
+        """ run one exiftool command; returns the error and warning
+        lines it printed """
+        if not self.proc or self.proc.poll() is not None:
+            self.start()
+        self.counter = self.counter + 1
+        marker = "{ready%d}" % self.counter
+        args = params + ["-echo4", marker, "-execute%d" % self.counter]
+        self.proc.stdin.write("\n".join(args) + "\n")
+        self.proc.stdin.flush()
+        stdout = self.readuntil(self.proc.stdout, marker)
+        stderr = self.readuntil(self.proc.stderr, marker)
+        errors = [line for line in stderr if line.strip()]
+        errors.extend(
+            line.strip() for line in stdout if "files weren't updated" in line
+        )
+        return errors
+
+    def stop(self):
+        if not self.proc or self.proc.poll() is not None:
+            return
+        try:
+            self.proc.stdin.write("-stay_open\nFalse\n")
+            self.proc.stdin.flush()
+            self.proc.wait(timeout=30)
+        except Exception as e:
+            logging.error("stopping exiftool failed: %s", e)
+            self.proc.kill()
+
+
+class ExifTools(object):
+    """ a fixed number of exiftool processes shared by every silo;
+    a command goes to whichever process is idle first """
+
+    def __init__(self, workers):
+        self.workers = [ExifTool() for i in range(workers)]
+        self.idle = queue.Queue()
+        for worker in self.workers:
+            self.idle.put(worker)
+        self.errors = {}
+        self.errors_lock = threading.Lock()
+        atexit.register(self.stop)
+
+    def execute(self, params):
+        fpath = params[-1]
+        worker = self.idle.get()
+        try:
+            errors = worker.execute(params)
+        except Exception as e:
+            worker.stop()
+            worker.proc = None
+            errors = ["%s" % e]
+        finally:
+            self.idle.put(worker)
+        if errors:
+            with self.errors_lock:
+                self.errors[fpath] = errors
+        return errors
+
+    def stop(self):
+        for worker in self.workers:
+            worker.stop()
+        if self.errors:
+            logging.warning(
+                "exiftool reported errors for %d files", len(self.errors)
+            )
+
+
+_exiftools = None
+_exiftools_lock = threading.Lock()
+
+
+def exiftools():
+    global _exiftools
+    with _exiftools_lock:
+        if not _exiftools:
+            _exiftools = ExifTools(int(settings.args.get("exiftool_workers")))
+        return _exiftools
+
+
+class Metrics(object):
+    """ counters and latency histograms of a run, written as a Prometheus
+    node exporter textfile and a JSON summary at exit
+
+    unless one of the outputs was asked for every call returns right
+    away, so the instrumentation costs next to nothing when disabled
+    """
+
+    PREFIX = "silopasta_"
+    BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+    HELP = {
+        "http_requests_total": ("counter", "HTTP requests sent"),
+        "http_bytes_total": ("counter", "bytes downloaded"),
+        "http_request_seconds": ("histogram", "HTTP request latency"),
+        "http_cache_hits_total": ("counter", "responses served from the cache"),
+        "http_retries_total": ("counter", "HTTP requests retried"),
+        "http_throttled_total": ("counter", "times a host asked to slow down"),
+        "bandwidth_wait_seconds_total": (
+            "counter",
+            "time downloads waited for the bandwidth budget",
+        ),
+        "api_pages_total": ("counter", "silo API pages fetched"),
+        "items_skipped_total": ("counter", "items skipped as already archived"),
+        "fav_fetch_seconds": ("histogram", "time to download the images of a fav"),
+        "images_total": ("counter", "downloads by detected image type"),
+        "exif_seconds": ("histogram", "time to write metadata into an image"),
+        "sidecar_seconds": ("histogram", "time to write a markdown sidecar"),
+        "stage_seconds": ("histogram", "time an item spent in a pipeline stage"),
+        "run_started_timestamp_seconds": ("gauge", "start of the last run"),
+        "run_duration_seconds": ("gauge", "duration of the last run"),
+    }
+
+    def __init__(self, textfile=None, summary=None):
+        self.textfile = textfile
+        self.summary = summary
+        self.enabled = bool(textfile or summary)
+        self.started = time.time()
+        self.counters = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+        if self.enabled:
+            atexit.register(self.write)
+
+    def inc(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = [[0] * len(self.BUCKETS), 0, 0.0]
+            histogram = self.histograms[key]
+            bucket = bisect_left(self.BUCKETS, seconds)
+            if bucket < len(self.BUCKETS):
+                histogram[0][bucket] = histogram[0][bucket] + 1
+            histogram[1] = histogram[1] + 1
+            histogram[2] = histogram[2] + seconds
+
+    def timer(self, name, **labels):
+        """ context manager observing the time spent in its block """
+        if not self.enabled:
+            return nullcontext()
+        return self.timed(name, labels)
+
+    @contextmanager
+    def timed(self, name, labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def gauges(self):
+        return {
+            ("run_started_timestamp_seconds", ()): self.started,
+            ("run_duration_seconds", ()): time.time() - self.started,
+        }
+
+    @staticmethod
+    def labelstr(labels):
+        if not labels:
+            return ""
+        return "{%s}" % ",".join(
+            '%s="%s"'
+            % (
+                k,
+                ("%s" % v)
+                .replace("\\", "\\\\")
+                .replace('"', '\\"')
+                .replace("\n", "\\n"),
+            )
+            for k, v in labels
+        )
+
+    def prometheus(self):
+        """ the text exposition format, as read by the node exporter """
+        with self.lock:
+            values = dict(self.counters)
+            histograms = {
+                key: (list(buckets), count, total)
+                for key, (buckets, count, total) in self.histograms.items()
+            }
+        values.update(self.gauges())
+        lines = []
+        for name, (kind, description) in self.HELP.items():
+            metric = "%s%s" % (self.PREFIX, name)
+            if kind == "histogram":
+                series = sorted(k for k in histograms if k[0] == name)
+            else:
+                series = sorted(k for k in values if k[0] == name)
+            if not series:
+                continue
+            lines.append("# HELP %s %s" % (metric, description))
+            lines.append("# TYPE %s %s" % (metric, kind))
+            for key in series:
+                labels = key[1]
+                if kind != "histogram":
+                    lines.append(
+                        "%s%s %s" % (metric, self.labelstr(labels), values[key])
+                    )
+                    continue
+                buckets, count, total = histograms[key]
+                cumulative = 0
+                for le, n in zip(self.BUCKETS, buckets):
+                    cumulative = cumulative + n
+                    lines.append(
+                        "%s_bucket%s %d"
+                        % (metric, self.labelstr(labels + (("le", le),)), cumulative)
+                    )
+                lines.append(
+                    "%s_bucket%s %d"
+                    % (metric, self.labelstr(labels + (("le", "+Inf"),)), count)
+                )
+                lines.append("%s_sum%s %s" % (metric, self.labelstr(labels), total))
+                lines.append("%s_count%s %d" % (metric, self.labelstr(labels), count))
+        return "\n".join(lines) + "\n"
+
+    def report(self):
+        """ everything recorded in the run, as a dict for the summary """
+        with self.lock:
+            counters = [
+                {"name": name, "labels": dict(labels), "value": value}
+                for (name, labels), value in sorted(self.counters.items())
+            ]
+            histograms = [
+                {
+                    "name": name,
+                    "labels": dict(labels),
+                    "count": count,
+                    "sum": round(total, 6),
+                    "buckets": dict(zip(self.BUCKETS, buckets)),
+                }
+                for (name, labels), (buckets, count, total) in sorted(
+                    self.histograms.items()
+                )
+            ]
+        return {
+            "started": arrow.get(self.started).isoformat(),
+            "duration": round(time.time() - self.started, 3),
+            "counters": counters,
+            "histograms": histograms,
+        }
+
+    def write(self):
+        """ replace the outputs atomically, so the node exporter never
+        reads a half written file """
+        outputs = []
+        if self.textfile:
+            outputs.append((self.textfile, self.prometheus()))
+        if self.summary:
+            outputs.append(
+                (self.summary, json.dumps(self.report(), indent=4) + "\n")
+            )
+        for fpath, content in outputs:
+            tmp = "%s%s" % (fpath, TMPFEXT)
+            try:
+                with open(tmp, "wt") as f:
+                    f.write(content)
+                os.replace(tmp, fpath)
+            except OSError as e:
+                logging.error("writing metrics to %s failed: %s", fpath, e)
+
+
+_metrics = None
+_metrics_lock = threading.Lock()
+
+
+def metrics():
+    global _metrics
+    with _metrics_lock:
+        if not _metrics:
+            _metrics = Metrics(
+                settings.args.get("metrics_textfile"),
+                settings.args.get("metrics_summary"),
+            )
+        return _metrics
+
+
+class Pipeline(object):
+    """ stages connected by bounded queues, each stage served by its own
+    worker threads
+
+    a stage is a method taking an item and returning the item for the
+    next stage, or None to drop it; the source, usually a generator
+    paging through a silo, blocks whenever the first queue is full
+
+    an item a stage failed on is dropped and counted in failed; if the
+    source fails, what was queued is finished before its exception is
+    raised again
+    """
+
+    DONE = object()
+
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+        self.stages = []
+        self.stats = {}
+        self.failed = 0
+        self.stats_lock = threading.Lock()
+
+    def stage(self, name, method, workers):
+        self.stages.append((name, method, max(1, workers)))
+
+    def account(self, name, elapsed):
+        with self.stats_lock:
+            count, total = self.stats.get(name, (0, 0.0))
+            self.stats[name] = (count + 1, total + elapsed)
+        metrics().observe("stage_seconds", elapsed, silo=self.name, stage=name)
+
+    def worker(self, name, method, inq, outq):
+        while True:
+            item = inq.get()
+            if item is self.DONE:
+                return
+            start = time.perf_counter()
+            try:
+                item = method(item)
+            except Exception as e:
+                logging.error(
+                    "%s %s stage failed on %s: %s", self.name, name, item, e
+                )
+                with self.stats_lock:
+                    self.failed = self.failed + 1
+                item = None
+            self.account(name, time.perf_counter() - start)
+            if item is not None and outq is not None:
+                outq.put(item)
+
+    def run(self, source):
+        queues = [queue.Queue(self.size) for stage in self.stages]
+        threads = []
+        for i, (name, method, workers) in enumerate(self.stages):
+            outq = queues[i + 1] if i + 1 < len(queues) else None
+            threads.append(
+                [
+                    threading.Thread(
+                        target=self.worker,
+                        args=(name, method, queues[i], outq),
+                        name="%s-%s-%d" % (self.name, name, n),
+                        daemon=True,
+                    )
+                    for n in range(workers)
+                ]
+            )
+        for thread in sum(threads, []):
+            thread.start()
+
+        source = iter(source)
+        error = None
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(source)
+            except StopIteration:
+                break
+            except Exception as e:
+                logging.error("%s paging failed: %s", self.name, e)
+                error = e
+                break
+            self.account("page", time.perf_counter() - start)
+            queues[0].put(item)
+
+        for inq, workers in zip(queues, threads):
+            for thread in workers:
+                inq.put(self.DONE)
+            for thread in workers:
+                thread.join()
+
+        for name, (count, total) in self.stats.items():
+            logging.info(
+                "%s %s stage: %d items in %.2fs", self.name, name, count, total
+            )
+        if error is not None:
+            raise error
+
+
+class ContentHash(object):
+    """ SHA-256 of a JPEG or PNG fed to it piece by piece, leaving out
+    the APP1 segment or iTXt chunk holding its XMP packet, so a fresh
+    download and an archived copy tagged for a fav share the same key;
+    anything else, or whatever stops parsing, is hashed as it is """
+
+    def __init__(self):
+        self.sha256 = hashlib.sha256()
+        self.buf = b""
+        self.state = None
+        self.copy = 0
+        self.skip = 0
+
+    def update(self, data):
+        self.buf = self.buf + data
+        while self.buf:
+            if self.copy or self.skip:
+                n = min(self.copy or self.skip, len(self.buf))
+                if self.copy:
+                    self.sha256.update(self.buf[:n])
+                    self.copy = self.copy - n
+                else:
+                    self.skip = self.skip - n
+                self.buf = self.buf[n:]
+            elif not self.step():
+                return
+
+    def step(self):
+        """ work out what the next piece is; False if that needs more """
+        buf = self.buf
+        if self.state is None:
+            if len(buf) < len(PNGSIG) and PNGSIG.startswith(buf):
+                return False
+            if buf.startswith(PNGSIG):
+                self.state = "png"
+                self.copy = len(PNGSIG)
+            elif buf[:2] == b"\xff\xd8":
+                self.state = "jpeg"
+                self.copy = 2
+            else:
+                self.state = "raw"
+        elif self.state == "jpeg":
+            if len(buf) < 4:
+                return False
+            if buf[0] != 0xFF or buf[1] in (0xDA, 0xD9):
+                self.state = "raw"
+            elif buf[1] == 0xFF:
+                self.copy = 1
+            else:
+                size = 2 + struct.unpack(">H", buf[2:4])[0]
+                if buf[1] != 0xE1:
+                    self.copy = size
+                elif len(buf) < min(size, 4 + len(XMPSIG)):
+                    return False
+                elif buf[4:size].startswith(XMPSIG):
+                    self.skip = size
+                else:
+                    self.copy = size
+        elif self.state == "png":
+            if len(buf) < 8:
+                return False
+            size = 12 + struct.unpack(">I", buf[:4])[0]
+            key = PNGXMPKEY + b"\x00"
+            if buf[4:8] != b"iTXt":
+                self.copy = size
+            elif len(buf) < min(size, 8 + len(key)):
+                return False
+            elif buf[8:size].startswith(key):
+                self.skip = size
+            else:
+                self.copy = size
+        else:
+            self.copy = len(buf)
+        return True
+
+    def hexdigest(self):
+        sha256 = self.sha256.copy()
+        sha256.update(self.buf)
+        return sha256.hexdigest()
+
+
+def contenthash(fpath, hasher=None):
+    """ feed a file to a ContentHash a chunk at a time """
+    if hasher is None:
+        hasher = ContentHash()
+    with open(fpath, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNKSIZE), b""):
+            hasher.update(chunk)
+    return hasher
+
+
+def xmppacket(fpath):
+    """ the XMP segment or chunk of a JPEG or PNG, b"" if it has none;
+    only the headers are read, image data is skipped over """
+    with open(fpath, "rb") as f:
+        head = f.read(len(PNGSIG))
+        if head.startswith(PNGSIG):
+            key = PNGXMPKEY + b"\x00"
+            while True:
+                header = f.read(8)
+                if len(header) < 8 or header[4:8] == b"IEND":
+                    return b""
+                size = struct.unpack(">I", header[:4])[0]
+                if header[4:8] == b"iTXt":
+                    body = f.read(size + 4)
+                    if body.startswith(key):
+                        return header + body
+                else:
+                    f.seek(size + 4, os.SEEK_CUR)
+        if head[:2] == b"\xff\xd8":
+            f.seek(2)
+            while True:
+                header = f.read(4)
+                if len(header) < 4 or header[0] != 0xFF or header[1] in (0xDA, 0xD9):
+                    return b""
+                if header[1] == 0xFF:
+                    f.seek(-3, os.SEEK_CUR)
+                    continue
+                size = struct.unpack(">H", header[2:4])[0] - 2
+                if header[1] == 0xE1:
+                    body = f.read(size)
+                    if body.startswith(XMPSIG):
+                        return header + body
+                else:
+                    f.seek(size, os.SEEK_CUR)
+    return b""
+
+
+class Blobs(object):
+    """ content addressed store of archived files, keyed by SHA-256
+
+    the key is the hash of the file with its XMP packet left out, see
+    ContentHash; the blob is the first archived copy, metadata and all,
+    and a later copy becomes a hardlink to it only if it carries the
+    very same XMP packet, so no fav ends up tagged with the source of
+    another one
+    """
+
+    def __init__(self, root, index):
+        self.root = root
+        self.index = index
+
+    def path(self, sha256, ext):
+        return os.path.join(self.root, sha256[:2], sha256[2:4], sha256 + ext)
+
+    def lookup(self, sha256):
+        with self.index.lock:
+            row = self.index.db.execute(
+                "SELECT fname FROM blobs WHERE sha256 = ?", (sha256,)
+            ).fetchone()
+        if not row:
+            return None
+        fpath = os.path.join(self.root, row[0])
+        if not os.path.exists(fpath):
+            return None
+        return fpath
+
+    def relink(self, blob, target):
+        tmp = "%s%s" % (target, TMPFEXT)
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        try:
+            os.link(blob, tmp)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            shutil.copy2(blob, tmp)
+        os.replace(tmp, target)
+        self.index.restat(os.path.relpath(target, self.index.root))
+
+    def link(self, sha256, target):
+        """ replace target with a hardlink to the blob if there is one
+        and its XMP packet is the same as that of target """
+        blob = self.lookup(sha256)
+        if not blob or os.path.samefile(blob, target):
+            return False
+        if xmppacket(blob) != xmppacket(target):
+            return False
+        self.relink(blob, target)
+        return True
+
+    def store(self, sha256, fpath):
+        """ make an archived file the blob for sha256 """
+        blob = self.path(sha256, os.path.splitext(fpath)[1])
+        if not os.path.isdir(os.path.dirname(blob)):
+            os.makedirs(os.path.dirname(blob))
+        if os.path.exists(blob):
+            os.remove(blob)
+        try:
+            os.link(fpath, blob)
+        except OSError as e:
+            logging.warning("can't add %s to the blob store: %s", fpath, e)
+            return
+        with self.index.lock, self.index.db:
+            self.index.db.execute(
+                "INSERT OR REPLACE INTO blobs VALUES (?, ?)",
+                (sha256, os.path.relpath(blob, self.root)),
+            )
+
+    def dedupe(self, root):
+        """ replace identical files under root with hardlinks to a blob;
+        files archived before the blob store, and blobs keyed by an
+        earlier kind of key, get the key new downloads get; files with
+        the same image but tagged for another fav are left alone """
+        saved = 0
+        for dirpath, dirnames, fnames in os.walk(root):
+            dirnames[:] = sorted(d for d in dirnames if not d.startswith("."))
+            for fname in sorted(fnames):
+                fpath = os.path.join(dirpath, fname)
+                if (
+                    fname.startswith(".")
+                    or fname.endswith(MDFEXT)
+                    or fname.endswith(TMPFEXT)
+                    or not os.path.isfile(fpath)
+                ):
+                    continue
+                sha256 = contenthash(fpath).hexdigest()
+                if not self.lookup(sha256):
+                    self.store(sha256, fpath)
+                    continue
+                size = os.path.getsize(fpath)
+                if self.link(sha256, fpath):
+                    saved = saved + size
+                    logging.info("%s is now a link to %s", fname, sha256)
+        logging.info("deduplication freed %d bytes", saved)
+
+
+_blobs = None
+_blobs_lock = threading.Lock()
+
+
+def blobs():
+    global _blobs
+    with _blobs_lock:
+        if not _blobs:
+            _blobs = Blobs(
+                os.path.join(settings.paths.get("archive"), ".blobs"),
+                favindex(),
+            )
+        return _blobs
+
+
 class Favs(object):
     def __init__(self, silo):
         self.silo = silo
+        self.started = int(time.time())
+        # newest fav seen and the start of the last complete run
+        self.cursor = favindex().meta("cursor:%s" % silo, {})
 
     @property
     def feeds(self):
@@ -119,15 +2289,101 @@ class Favs(object):
 
     @property
     def since(self):
-        d = os.path.join(
-            settings.paths.get("archive"), "favorite", "%s*" % self.silo
+        if self.cursor.get("synced"):
+            return self.cursor.get("synced")
+        return favindex().since(self.silo)
+
+    def seen(self, favs):
+        """ note a page of favs in the cursor; True if all of them are
+        archived already, which is where paging newest first can stop
+
+        this has to be asked before the page is handed to the pipeline,
+        which would be archiving them meanwhile
+        """
+        for fav in favs:
+            published = calendar.timegm(fav.published.utctimetuple())
+            if published >= self.cursor.get("published", 0):
+                self.cursor.update({"id": "%s" % fav.id, "published": published})
+        if not len(favs) or settings.args.get("verify"):
+            return False
+        if not all(fav.exists for fav in favs):
+            return False
+        logging.info("%s reached a page of archived favs, stopping", self.silo)
+        return True
+
+    def favs(self):
+        return []
+
+    def queue(self, favs):
+        """ journal the favs that aren't archived yet as they're handed
+        to the pipeline """
+        for fav in favs:
+            if not fav.exists:
+                favindex().journal(fav.key, fav.targetprefix, QUEUED)
+            yield fav
+
+    def fetch(self, fav):
+        """ the fetch stage, noting favs that are left for the next run """
+        fetched = fav.fetch()
+        if fetched is None and not fav.exists:
+            self.complete = False
+        return fetched
+
+    def run(self):
+        """ archive every fav; the cursor only moves past this run once
+        paging finished and every fav made it into the index, otherwise
+        the next run would ask for favs newer than the ones left over """
+        self.complete = True
+        favindex().recover(self.silo)
+        self.pipeline = pipeline = Pipeline(
+            self.silo, int(settings.args.get("queue_size"))
         )
-        files = glob.glob(d)
-        if len(files):
-            mtime = max([int(os.path.getmtime(f)) for f in files])
+        pipeline.stage(
+            "fetch",
+            self.fetch,
+            int(settings.args.get("fetch_workers")),
+        )
+        pipeline.stage(
+            "exif",
+            methodcaller("embed"),
+            int(settings.args.get("exiftool_workers")),
+        )
+        pipeline.stage(
+            "save",
+            methodcaller("save_txt"),
+            int(settings.args.get("save_workers")),
+        )
+        pipeline.run(self.queue(self.favs()))
+        if pipeline.failed:
+            self.complete = False
+        if self.complete:
+            self.cursor["synced"] = self.started
         else:
-            mtime = 0
-        return mtime
+            logging.warning(
+                "%s left favs for the next run, keeping its sync time", self.silo
+            )
+        favindex().setmeta("cursor:%s" % self.silo, self.cursor)
+
+
+def favindex():
+    return Index.get(
+        os.path.join(settings.paths.get("archive"), "favorite"),
+        sharded=True,
+        sidecars=True,
+    )
+
+
+def favprefix(key, published):
+    """ the targetprefix of a fav under the configured layout """
+    return os.path.join(
+        favindex().root,
+        sharddir(
+            key,
+            calendar.timegm(published.utctimetuple()),
+            settings.args.get("layout"),
+        ),
+        key,
+    )
 
 
 class ImgFav(object):
@@ -135,23 +2391,72 @@ class ImgFav(object):
         return
 
     def run(self):
-        if not self.exists:
-            self.fetch_images()
+        if self.fetch():
+            self.embed()
             self.save_txt()
 
+    def fetch(self):
+        if self.exists:
+            metrics().inc("items_skipped_total", silo=favindex().silo_of(self.key))
+            if settings.args.get("verify"):
+                self.verify()
+            return None
+        os.makedirs(os.path.dirname(self.targetprefix), exist_ok=True)
+        favindex().journal(self.key, self.targetprefix, DOWNLOADING)
+        with metrics().timer("fav_fetch_seconds", silo=favindex().silo_of(self.key)):
+            complete = self.fetch_images()
+        if not complete:
+            logging.warning("%s is incomplete, leaving it for next run", self)
+            return None
+        favindex().journal(self.key, self.targetprefix, EMBEDDING)
+        return self
+
+    def verify(self):
+        """ check an archived fav: local files against the index, and
+        the originals with conditional requests, re-archiving it if
+        anything is missing locally """
+        broken = favindex().unverified(self.key)
+        if broken:
+            logging.warning("%s has missing files: %s", self, broken)
+            favindex().remove(self.key)
+            return self.run()
+        for fpath, url in self.images.items():
+            known = favindex().download(url)
+            if not known or not known.get("complete"):
+                continue
+            status = http().call(
+                http().check(url, known.get("etag"), known.get("modified"))
+            )
+            if status == 304:
+                logging.debug("%s is unchanged", url)
+            elif status == 200:
+                logging.info("%s changed since it was archived", url)
+            else:
+                logging.warning("%s responded with %d", url, status)
+
+    def embed(self):
+        for fpath, imgtype, sha256 in self.fetched:
+            self.embed_image(fpath, imgtype, sha256)
+        return self
+
+    @property
+    def key(self):
+        return os.path.basename(self.targetprefix)
+
     @property
     def exists(self):
-        maybe = glob.glob("%s*" % self.targetprefix)
-        if len(maybe):
-            return True
-        return False
+        return favindex().exists(self.key)
+
+    @cached_property
+    def fetched(self):
+        return []
+
+    @cached_property
+    def attachments(self):
+        return []
 
     def save_txt(self):
-        attachments = [
-            os.path.basename(fn)
-            for fn in glob.glob("%s*" % self.targetprefix)
-            if not os.path.basename(fn).endswith(".md")
-        ]
+        attachments = sorted(self.attachments)
         meta = {
             "title": self.title,
             "favorite-of": self.url,
@@ -160,66 +2465,133 @@ class ImgFav(object):
             "attachments": attachments,
             "author": self.author,
         }
-        r = "---\n%s\n---\n\n" % (utfyamldump(meta))
-        with open("%s%s" % (self.targetprefix, MDFEXT), "wt") as fpath:
-            fpath.write(r)
+        with metrics().timer("sidecar_seconds"):
+            r = "---\n%s\n---\n\n" % (utfyamldump(meta))
+            atomicwrite("%s%s" % (self.targetprefix, MDFEXT), r)
+        subdir = os.path.relpath(os.path.dirname(self.targetprefix), favindex().root)
+        favindex().add(
+            self.key,
+            url=self.url,
+            published=calendar.timegm(self.published.utctimetuple()),
+            fnames=[
+                os.path.normpath(os.path.join(subdir, fname))
+                for fname in attachments + ["%s%s" % (self.key, MDFEXT)]
+            ],
+        )
+
+    def resumable(self, fpath, url):
+        """ the download record of a partial file left for this image """
+        known = favindex().download(url)
+        if not known or known.get("complete"):
+            return None
+        known["fpath"] = os.path.join(favindex().root, known.get("fname"))
+        if os.path.splitext(known["fpath"])[0] != os.path.splitext(fpath)[0]:
+            return None
+        if not os.path.exists("%s%s" % (known["fpath"], TMPFEXT)):
+            return None
+        return known
+
+    @property
+    def faved(self):
+        """ when the fav was made, None where the silo doesn't tell; on
+        some silos published is when the image was uploaded """
+        return None
+
+    @property
+    def priority(self):
+        """ favs made in the last RECENTDAYS days are downloaded first """
+        when = self.faved or self.published
+        age = time.time() - calendar.timegm(when.utctimetuple())
+        if age < RECENTDAYS * 86400:
+            return RECENT
+        return BACKFILL
+
+    def transfer(self, fpath, url):
+        return http().fetch(
+            url,
+            fpath,
+            resume=self.resumable(fpath, url),
+            sniff=True,
+            priority=self.priority,
+            silo=favindex().silo_of(self.key),
+            started=favindex().transferred,
+        )
 
     def fetch_images(self):
-        for fpath, url in self.images.items():
-            self.fetch_image(fpath, url)
-
-    def fetch_image(self, fpath, url):
-        logging.info("pulling image %s to %s", url, fpath)
-        r = requests.get(url, stream=True)
-        if r.status_code == 200:
-            with open(fpath, "wb") as f:
-                r.raw.decode_content = True
-                shutil.copyfileobj(r.raw, f)
-
-        imgtype = imghdr.what(fpath)
-        if not imgtype:
-            os.remove(fpath)
-            return
-        if imgtype in ["jpg", "jpeg", "png"]:
-            self.write_exif(fpath)
-        os.rename(fpath, fpath.replace(TMPFEXT, ".%s" % (imgtype)))
+        """ download every image at once; False if any of them is to be
+        tried again, because it broke off or the server failed it """
+        pending = [
+            http().submit(self.transfer(fpath, url))
+            for fpath, url in self.images.items()
+        ]
+        complete = True
+        for future in pending:
+            complete = self.fetched_image(future.result()) and complete
+        return complete
 
-    def write_exif(self, fpath):
-        logging.info("populating EXIF data of %s" % fpath)
+    def fetched_image(self, transfer):
+        favindex().transferred(transfer)
+        if transfer.complete:
+            self.fetched.append((transfer.fpath, transfer.imgtype, transfer.sha256))
+        return transfer.complete or transfer.status in GONE_STATUSES
+
+    def embed_image(self, fpath, imgtype, sha256=None):
+        if imgtype in ["jpeg", "png"]:
+            self.write_exif(fpath, imgtype)
+        if sha256 and blobs().link(sha256, fpath):
+            logging.info("%s is a duplicate of %s", fpath, sha256)
+        elif sha256 and not blobs().lookup(sha256):
+            blobs().store(sha256, fpath)
+        self.attachments.append(os.path.basename(fpath))
 
-        geo_lat = False
-        geo_lon = False
+    @property
+    def exifgeo(self):
+        """ (lat, lon) rounded to 6 digits, or None """
+        if not hasattr(self, "geo") or self.geo == None:
+            return None
+        lat, lon = self.geo
+        if lat and lon and "null" != lat and "null" != lon:
+            return (round(float(lat), 6), round(float(lon), 6))
+        return None
+
+    @property
+    def copyright(self):
+        return "Copyright %s %s (%s)" % (
+            self.published.to("utc").format("YYYY"),
+            self.author.get("name"),
+            self.author.get("url"),
+        )
 
-        if hasattr(self, "geo") and self.geo != None:
-            lat, lon = self.geo
-            if lat and lon and "null" != lat and "null" != lon:
-                geo_lat = lat
-                geo_lon = lon
+    def xmp(self):
+        return XMP(
+            copyright=self.copyright,
+            source=self.url,
+            released=self.published.to("utc").strftime("%Y-%m-%dT%H:%M:%S"),
+            headline=self.title,
+            description=self.content,
+            subjects=self.tags,
+        )
 
+    def exifparams(self, fpath):
         params = [
-            "exiftool",
             "-overwrite_original",
-            "-XMP:Copyright=Copyright %s %s (%s)"
-            % (
-                self.published.to("utc").format("YYYY"),
-                self.author.get("name"),
-                self.author.get("url"),
-            ),
-            "-XMP:Source=%s" % self.url,
+            "-ec",
+            "-XMP:Copyright=%s" % exifescape(self.copyright),
+            "-XMP:Source=%s" % exifescape(self.url),
             "-XMP:ReleaseDate=%s"
-            % self.published.to("utc").format("YYYY:MM:DD HH:mm:ss"),
-            "-XMP:Headline=%s" % self.title,
-            "-XMP:Description=%s" % self.content,
+            % self.published.to("utc").strftime("%Y:%m:%d %H:%M:%S"),
+            "-XMP:Headline=%s" % exifescape(self.title),
+            "-XMP:Description=%s" % exifescape(self.content),
         ]
 
         for t in self.tags:
+            t = exifescape(t)
             params.append("-XMP:HierarchicalSubject+=%s" % t)
             params.append("-XMP:Subject+=%s" % t)
 
-        if geo_lat and geo_lon:
-            geo_lat = round(float(geo_lat), 6)
-            geo_lon = round(float(geo_lon), 6)
-
+        geo = self.exifgeo
+        if geo:
+            geo_lat, geo_lon = geo
             if geo_lat < 0:
                 GPSLatitudeRef = "S"
             else:
@@ -236,15 +2608,31 @@ class ImgFav(object):
             params.append("-GPSLatitudeRef=%s" % GPSLatitudeRef)
 
         params.append(fpath)
+        return params
 
-        p = subprocess.Popen(
-            params,
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-        )
+    def write_exif(self, fpath, imgtype=None):
+        logging.info("populating EXIF data of %s" % fpath)
+
+        if (
+            settings.args.get("metadata_engine") == "native"
+            and imgtype in XMP.FORMATS
+            and not self.exifgeo
+        ):
+            try:
+                with metrics().timer("exif_seconds", engine="native"):
+                    self.xmp().write(fpath, imgtype)
+                return
+            except ValueError as e:
+                logging.warning(
+                    "native metadata writer failed on %s: %s, using exiftool",
+                    fpath,
+                    e,
+                )
 
-        stdout, stderr = p.communicate()
+        with metrics().timer("exif_seconds", engine="exiftool"):
+            errors = exiftools().execute(self.exifparams(fpath))
+        for error in errors:
+            logging.error("exiftool on %s: %s", fpath, error)
         _original = "%s_original" % fpath
         if os.path.exists(_original):
             os.unlink(_original)
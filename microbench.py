@@ -0,0 +1,167 @@
+""" microbenchmarks for the helpers in common that run for every
+archived item, with stored baselines
+
+    python3 microbench.py              # compare against microbench.json
+    python3 microbench.py --save       # store the current numbers
+    python3 microbench.py --threshold 0.5
+
+exits with a non-zero status if any of them got slower than the
+baseline by more than the threshold
+
+every case is timed relative to a fixed calibration loop measured the
+same way, so a baseline stored on one machine holds on another, and
+the median of the repeats is compared; cases of a few microseconds are
+still noisier than the rest, and get twice the threshold
+"""
+
+import os
+import sys
+import json
+import types
+import importlib.util
+import atexit
+import shutil
+import timeit
+import argparse
+import tempfile
+import statistics
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "microbench.json")
+
+_parser = argparse.ArgumentParser(description="microbenchmarks for silo.pasta")
+_parser.add_argument("--save", action="store_true", help="store as new baseline")
+_parser.add_argument("--baseline", default=BASELINE)
+_parser.add_argument(
+    "--threshold",
+    default=0.25,
+    type=float,
+    help="allowed slowdown compared to the baseline, 0.25 is 25%%",
+)
+_parser.add_argument("--repeat", default=15, type=int)
+args = _parser.parse_args()
+sys.argv = sys.argv[:1]
+
+if importlib.util.find_spec("keys") is None:
+    sys.modules["keys"] = types.ModuleType("keys")
+
+import arrow
+import settings
+import common
+
+settings.paths["archive"] = tempfile.mkdtemp(prefix="silo-microbench-")
+atexit.register(shutil.rmtree, settings.paths["archive"], ignore_errors=True)
+common.favindex()
+
+# cases faster than this many microseconds get twice the threshold
+SMALL = 10
+
+TITLE = "Ünïcödé  Title — with “quotes”, emoji 🎨 & symbols: #art @someone [wip] ~ 50% off!"
+URL = "https://www.example-blog.tumblr.com/post/123456789012/some-very-long-slug-with-words?utm=1#x"
+CAPTION = (
+    "<p><a href=\"https://someone.tumblr.com/post/1\" class=\"tumblr_blog\">someone</a>:</p>"
+    "<blockquote><p>%s</p><p>Ünïcödé line\nwith a break and a \\ backslash</p></blockquote>"
+    % ("Lorem ipsum dolor sit amet, consectetur adipiscing elit. " * 80)
+)
+TAGS = ["tag number %d ünïcödé" % i for i in range(100)]
+
+
+class BenchFav(common.ImgFav):
+    """ a fav shaped like a long Tumblr photoset post """
+
+    silo = "bench"
+    url = URL
+    title = TITLE
+    content = CAPTION
+    tags = TAGS
+    author = {"name": "someone", "url": "https://someone.tumblr.com"}
+    published = arrow.get(1600000000)
+    geo = ("47.497912", "-19.040235")
+
+    def __init__(self):
+        self.attachments.extend("bench_123_%d.jpeg" % i for i in range(10))
+
+    @property
+    def targetprefix(self):
+        return os.path.join(settings.paths.get("archive"), "favorite", "bench_123")
+
+    @property
+    def images(self):
+        return {
+            "%s_%d%s" % (self.targetprefix, i, common.TMPFEXT): "%s/%d.jpg" % (URL, i)
+            for i in range(10)
+        }
+
+
+FAV = BenchFav()
+META = {
+    "title": TITLE,
+    "favorite-of": URL,
+    "date": str(FAV.published),
+    "sources": list(FAV.images.values()),
+    "attachments": sorted(FAV.attachments),
+    "author": FAV.author,
+}
+
+CASES = {
+    "slugify": (lambda: common.slugify(TITLE), 20000),
+    "slugify_caption": (lambda: common.slugify(CAPTION), 500),
+    "url2slug": (lambda: common.url2slug(URL), 20000),
+    "utfyamldump": (lambda: common.utfyamldump(META), 200),
+    "exifparams": (lambda: FAV.exifparams("/tmp/bench.jpeg"), 500),
+    "save_txt": (FAV.save_txt, 100),
+}
+
+
+def calibration():
+    """ pure interpreter work, standing in for the speed of the machine """
+    total = 0
+    for i in range(1000):
+        total = total + i % 7
+    return total
+
+
+def measure(method, number):
+    """ median time of a single call, in microseconds """
+    timer = timeit.Timer(method)
+    times = timer.repeat(repeat=args.repeat, number=number)
+    return statistics.median(times) / number * 1e6
+
+
+def main():
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    results = {"calibration": round(measure(calibration, 2000), 3)}
+    scale = 1.0
+    if baseline.get("calibration"):
+        scale = baseline["calibration"] / results["calibration"]
+    print("%-16s %12.3f us  x%.2f" % ("calibration", results["calibration"], scale))
+    slower = []
+    for name, (method, number) in CASES.items():
+        results[name] = round(measure(method, number), 3)
+        before = baseline.get(name)
+        if before:
+            change = results[name] * scale / before - 1
+            threshold = args.threshold
+            if before < SMALL:
+                threshold = threshold * 2
+            flag = ""
+            if change > threshold:
+                flag = "  SLOWER"
+                slower.append(name)
+            print("%-16s %12.3f us  %+7.1f%%%s" % (name, results[name], change * 100, flag))
+        else:
+            print("%-16s %12.3f us" % (name, results[name]))
+
+    if args.save:
+        with open(args.baseline, "wt") as f:
+            json.dump(results, f, indent=4, sort_keys=True)
+            f.write("\n")
+    if slower:
+        raise SystemExit("slower than the baseline: %s" % ", ".join(slower))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,90 @@
+import time
+import logging
+import importlib
+from concurrent.futures import ThreadPoolExecutor
 import common
 import settings
-import Tumblr
-import LastFM
-import DeviantArt
-import Flickr
-#import Artstation
-import HackerNews
 from pprint import pprint
 
-silos = [
-    Flickr.FlickrFavs(),
-    Tumblr.TumblrFavs(),
-    DeviantArt.DAFavs(),
-#    Artstation.ASFavs(),
-#    LastFM.LastFM(),
-    HackerNews.HackerNews()
-]
+# silo name: (module, class)
+SILOS = {
+    "flickr": ("Flickr", "FlickrFavs"),
+    "tumblr": ("Tumblr", "TumblrFavs"),
+    "deviantart": ("DeviantArt", "DAFavs"),
+    "artstation": ("Artstation", "ASFavs"),
+    "lastfm": ("LastFM", "LastFM"),
+    "hackernews": ("HackerNews", "HackerNews"),
+    "wallabag": ("Wallabag", "Wallabag"),
+}
+
 
-for silo in silos:
+def runsilo(name):
+    """ import, set up and run a single silo; everything that can go
+    wrong happens in here so one silo failing leaves the rest alone """
+    start = time.time()
+    module, cls = SILOS[name]
+    silo = getattr(importlib.import_module(module), cls)()
     silo.run()
+    return time.time() - start
+
+
+if settings.args.get("reindex"):
+    import HackerNews
+    common.favindex().rebuild()
+    HackerNews.HackerNews().rebuild()
+    if settings.paths.get("bookmarks"):
+        common.Index.get(settings.paths.get("bookmarks"), silo="wallabag").rebuild()
+    raise SystemExit(0)
+
+if settings.args.get("hn_export"):
+    import HackerNews
+    HackerNews.HackerNews().export(settings.args.get("hn_export"))
+    raise SystemExit(0)
+
+if settings.args.get("migrate") is not None:
+    common.favindex().migrate(
+        settings.args.get("layout"), settings.args.get("migrate")
+    )
+    raise SystemExit(0)
+
+if settings.args.get("recover"):
+    common.favindex().recover()
+    common.favindex().sweep()
+    raise SystemExit(0)
+
+if settings.args.get("dedupe"):
+    common.blobs().dedupe(common.favindex().root)
+    raise SystemExit(0)
+
+selected = [
+    name.strip().lower()
+    for name in settings.args.get("silos").split(",")
+    if name.strip()
+]
+for name in selected:
+    if name not in SILOS:
+        raise SystemExit(
+            "unknown silo: %s (available: %s)" % (name, ", ".join(SILOS))
+        )
+
+jobs = settings.args.get("jobs") or len(selected)
+started = common.metrics().started
+with ThreadPoolExecutor(max_workers=jobs, thread_name_prefix="silo") as pool:
+    futures = {name: pool.submit(runsilo, name) for name in selected}
+
+failed = []
+for name, future in futures.items():
+    try:
+        logging.info("%s finished in %.2fs", name, future.result())
+    except Exception as e:
+        logging.exception("%s failed: %s", name, e)
+        failed.append(name)
+
+logging.info(
+    "%d silos finished in %.2fs, %d failed",
+    len(selected),
+    time.time() - started,
+    len(failed),
+)
+if failed:
+    raise SystemExit("failed silos: %s" % ", ".join(failed))
@@ -16,6 +16,161 @@ loglevels = {"critical": 50, "error": 40, "warning": 30, "info": 20, "debug": 10
 
 _parser = argparse.ArgumentParser(description="Parameters for silo.pasta")
 _parser.add_argument("--loglevel", default="debug", help="change loglevel")
+_parser.add_argument(
+    "--silos",
+    default="flickr,tumblr,deviantart,hackernews",
+    help="comma separated list of silos to run",
+)
+_parser.add_argument(
+    "--jobs",
+    default=0,
+    type=int,
+    help="number of silos running at the same time, defaults to all",
+)
+_parser.add_argument(
+    "--workers",
+    default=32,
+    type=int,
+    help="number of HTTP connections open at the same time",
+)
+_parser.add_argument(
+    "--per-host",
+    default=4,
+    type=int,
+    help="maximum number of HTTP connections to the same host",
+)
+_parser.add_argument(
+    "--timeout",
+    default=60,
+    type=int,
+    help="seconds to wait for connecting to or reading from a server",
+)
+_parser.add_argument(
+    "--rate",
+    default=0,
+    type=float,
+    help="most requests per second to the same host; by default there's "
+    "no limit until a host pushes back, which it then adapts to",
+)
+_parser.add_argument(
+    "--bandwidth",
+    default=0,
+    type=int,
+    help="most KiB per second downloaded by all silos together; "
+    "0 for no limit",
+)
+_parser.add_argument(
+    "--silo-bandwidth",
+    default="",
+    help="comma separated silo=KiB per second download caps, "
+    "like flickr=512,tumblr=256",
+)
+_parser.add_argument(
+    "--downsize",
+    action="store_true",
+    help="archive Flickr favs below their original size while the "
+    "bandwidth budget is tight; these are not upgraded later",
+)
+_parser.add_argument(
+    "--exiftool-workers",
+    default=2,
+    type=int,
+    help="number of long running exiftool processes",
+)
+_parser.add_argument(
+    "--fetch-workers",
+    default=4,
+    type=int,
+    help="number of favs being downloaded at the same time",
+)
+_parser.add_argument(
+    "--save-workers",
+    default=1,
+    type=int,
+    help="number of threads writing markdown sidecars",
+)
+_parser.add_argument(
+    "--queue-size",
+    default=16,
+    type=int,
+    help="number of favs waiting between two pipeline stages",
+)
+_parser.add_argument(
+    "--lastfm-workers",
+    default=4,
+    type=int,
+    help="number of Last.fm pages fetched at the same time",
+)
+_parser.add_argument(
+    "--lastfm-rate",
+    default=5.0,
+    type=float,
+    help="Last.fm API requests per second",
+)
+_parser.add_argument(
+    "--metadata-engine",
+    default="exiftool",
+    choices=["exiftool", "native"],
+    help="write XMP metadata with exiftool or in-process; favs with GPS "
+    "coordinates always go to exiftool",
+)
+_parser.add_argument(
+    "--verify",
+    action="store_true",
+    help="re-check archived favs locally and against their originals",
+)
+_parser.add_argument(
+    "--dedupe",
+    action="store_true",
+    help="replace identical archived files with hardlinks and exit; copies "
+    "of an image tagged for different favs are kept apart",
+)
+_parser.add_argument(
+    "--cache-ttl",
+    default=0,
+    type=int,
+    help="seconds to keep API responses in an on-disk cache, 0 disables it",
+)
+_parser.add_argument(
+    "--metrics-textfile",
+    default=None,
+    help="write run metrics to this Prometheus node exporter textfile",
+)
+_parser.add_argument(
+    "--metrics-summary",
+    default=None,
+    help="write a JSON summary of the run metrics to this file",
+)
+_parser.add_argument(
+    "--layout",
+    default="flat",
+    choices=["flat", "date", "hash"],
+    help="directories of the favorite archive: all in one, silo/yyyy/mm "
+    "or 256 hash prefixes",
+)
+_parser.add_argument(
+    "--migrate",
+    default=None,
+    type=int,
+    help="move this many archived favs into --layout and exit, 0 for all",
+)
+_parser.add_argument(
+    "--recover",
+    action="store_true",
+    help="look through the whole favorite archive for files left by runs "
+    "that died, remove them and exit",
+)
+_parser.add_argument(
+    "--hn-export",
+    default=None,
+    help="write every archived HackerNews item as a JSON file into this "
+    "directory and exit",
+)
+_parser.add_argument(
+    "--reindex",
+    action="store_true",
+    help="rebuild the archive indexes from the files on disk and exit",
+)
 
 args = vars(_parser.parse_args())
 logging.basicConfig(
@@ -0,0 +1,307 @@
+""" the native metadata engine has to write valid files holding what
+exiftool writes: the files and packets it makes are taken apart here,
+and where exiftool is installed both engines tag copies of the same
+image and exiftool reads them back
+
+    python3 -m pytest test_metadata.py
+"""
+
+import os
+import sys
+import zlib
+import types
+import importlib.util
+import base64
+import struct
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+sys.argv = sys.argv[:1] + ["--metadata-engine", "native", "--loglevel", "warning"]
+
+if importlib.util.find_spec("keys") is None:
+    sys.modules["keys"] = types.ModuleType("keys")
+
+import arrow
+import lxml.etree as etree
+import settings
+import common
+
+JPEG = base64.b64decode(
+    "/9j/4AAQSkZJRgABAQAAAQABAAD/2wBDAAgGBgcGBQgHBwcJCQgKDBQNDAsLDBkSEw8UHRofHh0a"
+    "HBwgJC4nICIsIxwcKDcpLDAxNDQ0Hyc5PTgyPC4zNDL/2wBDAQkJCQwLDBgNDRgyIRwhMjIyMjIy"
+    "MjIyMjIyMjIyMjIyMjIyMjIyMjIyMjIyMjIyMjIyMjIyMjIyMjIyMjIyMjL/wAARCAACAAIDASIA"
+    "AhEBAxEB/8QAHwAAAQUBAQEBAQEAAAAAAAAAAAECAwQFBgcICQoL/8QAtRAAAgEDAwIEAwUFBAQA"
+    "AAF9AQIDAAQRBRIhMUEGE1FhByJxFDKBkaEII0KxwRVS0fAkM2JyggkKFhcYGRolJicoKSo0NTY3"
+    "ODk6Q0RFRkdISUpTVFVWV1hZWmNkZWZnaGlqc3R1dnd4eXqDhIWGh4iJipKTlJWWl5iZmqKjpKWm"
+    "p6ipqrKztLW2t7i5usLDxMXGx8jJytLT1NXW19jZ2uHi4+Tl5ufo6erx8vP09fb3+Pn6/8QAHwEA"
+    "AwEBAQEBAQEBAQAAAAAAAAECAwQFBgcICQoL/8QAtREAAgECBAQDBAcFBAQAAQJ3AAECAxEEBSEx"
+    "BhJBUQdhcRMiMoEIFEKRobHBCSMzUvAVYnLRChYkNOEl8RcYGRomJygpKjU2Nzg5OkNERUZHSElK"
+    "U1RVVldYWVpjZGVmZ2hpanN0dXZ3eHl6goOEhYaHiImKkpOUlZaXmJmaoqOkpaanqKmqsrO0tba3"
+    "uLm6wsPExcbHyMnK0tPU1dbX2Nna4uPk5ebn6Onq8vP09fb3+Pn6/9oADAMBAAIRAxEAPwDgqKKK"
+    "8M/VD//Z"
+)
+PNG = base64.b64decode(
+    "iVBORw0KGgoAAAANSUhEUgAAAAIAAAACCAIAAAD91JpzAAAAFklEQVR4nGM8wcXFwMDAxMDAwMDA"
+    "AAALOADgEfTV1gAAAABJRU5ErkJggg=="
+)
+
+
+class SampleFav(common.ImgFav):
+    silo = "test"
+    url = "https://example.com/photos/123/"
+    title = "Ünïcödé title — with “quotes” & <markup>"
+    content = "a description\nover two lines, with a \\ backslash"
+    tags = ["one", "two words", "ünïcödé"]
+    author = {"name": "someone", "url": "https://example.com/someone"}
+    published = arrow.get(1600000000)
+    geo = None
+
+
+def jpegsegments(data):
+    """ [(marker, payload)] of the segments before the image data, and
+    the image data; fails on anything that isn't laid out right """
+    assert data[:2] == b"\xff\xd8"
+    segments = []
+    pos = 2
+    while data[pos + 1] != 0xDA:
+        assert data[pos] == 0xFF, "no marker at %d" % pos
+        length = struct.unpack(">H", data[pos + 2 : pos + 4])[0]
+        assert pos + 2 + length <= len(data), "segment past the end"
+        segments.append((data[pos + 1], data[pos + 4 : pos + 2 + length]))
+        pos = pos + 2 + length
+    assert data.endswith(b"\xff\xd9")
+    return segments, data[pos:]
+
+
+def pngchunks(data):
+    """ [(type, body)] of every chunk, checking lengths and CRCs """
+    assert data.startswith(common.PNGSIG)
+    chunks = []
+    pos = len(common.PNGSIG)
+    while pos < len(data):
+        length = struct.unpack(">I", data[pos : pos + 4])[0]
+        ctype = data[pos + 4 : pos + 8]
+        body = data[pos + 8 : pos + 8 + length]
+        crc = struct.unpack(">I", data[pos + 8 + length : pos + 12 + length])[0]
+        assert crc == zlib.crc32(ctype + body) & 0xFFFFFFFF, "bad CRC"
+        chunks.append((ctype, body))
+        pos = pos + 12 + length
+    assert chunks[-1][0] == b"IEND"
+    return chunks
+
+
+def packets(data, imgtype):
+    """ the XMP packets in a JPEG or PNG """
+    if imgtype == "jpeg":
+        return [
+            payload[len(common.XMPSIG) :]
+            for marker, payload in jpegsegments(data)[0]
+            if marker == 0xE1 and payload.startswith(common.XMPSIG)
+        ]
+    key = common.PNGXMPKEY + b"\x00"
+    return [
+        body[len(key) + 4 :]
+        for ctype, body in pngchunks(data)
+        if ctype == b"iTXt" and body.startswith(key)
+    ]
+
+
+def properties(packet):
+    """ {prefix:name: text or [items]} of an XMP packet """
+    qname = common.XMP.qname
+    prefixes = {ns: prefix for prefix, ns in common.XMPNS.items()}
+    found = {}
+    root = etree.fromstring(packet)
+    for desc in root.iter(qname("rdf:Description")):
+        for el in desc:
+            tag = etree.QName(el)
+            name = "%s:%s" % (prefixes.get(tag.namespace, "?"), tag.localname)
+            items = [li.text for li in el.iter(qname("rdf:li"))]
+            found[name] = items if items else el.text
+    return found
+
+
+class TestXMP(unittest.TestCase):
+    """ what the native engine writes, taken apart without exiftool """
+
+    def tagged(self, fav, data, imgtype):
+        return getattr(fav.xmp(), imgtype)(data)
+
+    def test_jpeg_layout(self):
+        segments, scan = jpegsegments(JPEG)
+        tagged, tscan = jpegsegments(self.tagged(SampleFav(), JPEG, "jpeg"))
+        self.assertEqual(tscan, scan)
+        xmp = [
+            i
+            for i, (marker, payload) in enumerate(tagged)
+            if marker == 0xE1 and payload.startswith(common.XMPSIG)
+        ]
+        self.assertEqual(len(xmp), 1)
+        # right after the JFIF APP0, everything else as it was
+        self.assertEqual(xmp, [1])
+        self.assertEqual(tagged[:1] + tagged[2:], segments)
+
+    def test_png_layout(self):
+        chunks = pngchunks(PNG)
+        tagged = pngchunks(self.tagged(SampleFav(), PNG, "png"))
+        types = [ctype for ctype, body in tagged]
+        self.assertEqual(types.count(b"iTXt"), 1)
+        self.assertLess(types.index(b"iTXt"), types.index(b"IDAT"))
+        self.assertEqual([c for c in tagged if c[0] != b"iTXt"], chunks)
+
+    def check(self, fav, packet):
+        props = properties(packet)
+        self.assertEqual(props["dc:source"], fav.url)
+        self.assertEqual(props["photoshop:Headline"], fav.title)
+        self.assertEqual(props["dc:description"], [fav.content])
+        self.assertEqual(props["dc:subject"], fav.tags)
+        self.assertEqual(props["lr:hierarchicalSubject"], fav.tags)
+        self.assertEqual(props["pdf:Copyright"], fav.copyright)
+        self.assertEqual(props["xmpDM:releaseDate"], "2020-09-13T12:26:40")
+
+    def test_properties(self):
+        fav = SampleFav()
+        for data, imgtype in [(JPEG, "jpeg"), (PNG, "png")]:
+            found = packets(self.tagged(fav, data, imgtype), imgtype)
+            self.assertEqual(len(found), 1)
+            self.check(fav, found[0])
+
+    def test_replace(self):
+        """ tagging again replaces our properties and keeps the rest """
+        first = SampleFav()
+        first.tags = ["old", "tags"]
+        second = SampleFav()
+        second.title = "another title"
+        foreign = (
+            b'<x:xmpmeta xmlns:x="adobe:ns:meta/"><rdf:RDF xmlns:rdf='
+            b'"http://www.w3.org/1999/02/22-rdf-syntax-ns#"><rdf:Description '
+            b'rdf:about="" xmlns:xmp="http://ns.adobe.com/xap/1.0/">'
+            b"<xmp:CreatorTool>a camera</xmp:CreatorTool>"
+            b"</rdf:Description></rdf:RDF></x:xmpmeta>"
+        )
+        payload = common.XMPSIG + foreign
+        segment = b"\xff\xe1" + struct.pack(">H", len(payload) + 2) + payload
+        data = JPEG[:2] + segment + JPEG[2:]
+        for imgtype, data in [("jpeg", data), ("png", PNG)]:
+            data = self.tagged(first, data, imgtype)
+            data = self.tagged(second, data, imgtype)
+            found = packets(data, imgtype)
+            self.assertEqual(len(found), 1)
+            self.check(second, found[0])
+            if imgtype == "jpeg":
+                self.assertEqual(properties(found[0])["?:CreatorTool"], "a camera")
+
+
+def exiftoolxml(fpath, groups=("-XMP:all", "-EXIF:GPS*")):
+    """ {tag: text} of everything exiftool reads from the file, apart
+    from what only says which program wrote it """
+    out = subprocess.run(
+        ["exiftool", "-X"] + list(groups) + [fpath],
+        check=True,
+        capture_output=True,
+    ).stdout
+    desc = etree.fromstring(out).find(
+        "{http://www.w3.org/1999/02/22-rdf-syntax-ns#}Description"
+    )
+    tags = {}
+    for el in desc:
+        if el.tag.endswith("}XMPToolkit"):
+            continue
+        tags[el.tag] = "|".join(t.strip() for t in el.itertext() if t.strip())
+    return tags
+
+
+@unittest.skipUnless(shutil.which("exiftool"), "exiftool is not installed")
+class TestNativeEngine(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix="silo-test-")
+        settings.paths["archive"] = self.tmp
+        settings.args["metadata_engine"] = "native"
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def tagged(self, fav, data, imgtype, engine, groups=("-XMP:all", "-EXIF:GPS*")):
+        fpath = os.path.join(self.tmp, "%s.%s" % (engine, imgtype))
+        with open(fpath, "wb") as f:
+            f.write(data)
+        if engine == "native":
+            fav.xmp().write(fpath, imgtype)
+        else:
+            self.assertEqual(common.exiftools().execute(fav.exifparams(fpath)), [])
+        return exiftoolxml(fpath, groups)
+
+    def compare(self, fav, data, imgtype):
+        native = self.tagged(fav, data, imgtype, "native")
+        exiftool = self.tagged(fav, data, imgtype, "exiftool")
+        self.assertTrue(native)
+        self.assertEqual(native, exiftool)
+
+    def test_jpeg(self):
+        self.compare(SampleFav(), JPEG, "jpeg")
+
+    def test_png(self):
+        self.compare(SampleFav(), PNG, "png")
+
+    def test_geo(self):
+        """ the native engine writes the XMP of favs with coordinates the
+        way exiftool does; the GPS tags are left to exiftool """
+        fav = SampleFav()
+        fav.geo = ("47.497912", "-19.040235")
+        native = self.tagged(fav, JPEG, "jpeg", "native", ["-XMP:all"])
+        exiftool = self.tagged(fav, JPEG, "jpeg", "exiftool", ["-XMP:all"])
+        self.assertEqual(native, exiftool)
+        gps = self.tagged(fav, JPEG, "jpeg", "exiftool", ["-EXIF:GPS*"])
+        self.assertTrue(any("GPSLatitude" in tag for tag in gps))
+
+
+class TestContentHash(unittest.TestCase):
+    """ a tagged copy keys the same blob as the download it came from """
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix="silo-test-")
+        settings.paths["archive"] = self.tmp
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def tagged(self, data, imgtype, title):
+        fav = SampleFav()
+        fav.title = title
+        fpath = os.path.join(self.tmp, "%s.%s" % (title, imgtype))
+        with open(fpath, "wb") as f:
+            f.write(data)
+        fav.xmp().write(fpath, imgtype)
+        return fpath
+
+    def compare(self, data, imgtype):
+        plain = os.path.join(self.tmp, "plain.%s" % imgtype)
+        with open(plain, "wb") as f:
+            f.write(data)
+        one = self.tagged(data, imgtype, "one")
+        two = self.tagged(data, imgtype, "two")
+        digests = set(common.contenthash(f).hexdigest() for f in [one, two])
+        self.assertEqual(digests, {common.contenthash(plain).hexdigest()})
+
+        # the same as it comes in over the network, a few bytes at a time
+        hasher = common.ContentHash()
+        with open(one, "rb") as f:
+            for chunk in iter(lambda: f.read(7), b""):
+                hasher.update(chunk)
+        self.assertEqual({hasher.hexdigest()}, digests)
+
+        self.assertEqual(common.xmppacket(plain), b"")
+        self.assertIn(b"<dc:source>", common.xmppacket(one))
+        self.assertNotEqual(common.xmppacket(one), common.xmppacket(two))
+
+    def test_jpeg(self):
+        self.compare(JPEG, "jpeg")
+
+    def test_png(self):
+        self.compare(PNG, "png")
+
+
+if __name__ == "__main__":
+    unittest.main()